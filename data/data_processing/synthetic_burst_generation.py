@@ -3,23 +3,38 @@ import random
 import cv2
 import numpy as np
 import torch.nn.functional as F
+from PIL import Image
 from data.data_processing.camera_pipeline import *
 from data.utils.data_format_utils import torch_to_numpy, numpy_to_torch
 
 
-def random_crop(frames, crop_sz):
+def random_crop(frames, crop_sz, rng=None):
     """ Extract a random crop of size crop_sz from the input frames. If the crop_sz is larger than the input image size,
     then the largest possible crop of same aspect ratio as crop_sz will be extracted from frames, and upsampled to
     crop_sz.
+
+    frames is either a torch tensor of shape [..., H, W], a numpy image of shape [H, W, C] / [H, W] (e.g. as loaded
+    with cv2.imread) or a PIL image. Cropping the numpy / PIL image before converting it to a tensor avoids converting
+    the full image.
+
+    rng is an optional np.random.Generator used to sample the crop position. By default the python random module is
+    used.
     """
     if not isinstance(crop_sz, (tuple, list)):
         crop_sz = (crop_sz, crop_sz)
     crop_sz = torch.tensor(crop_sz).float()
 
-    shape = frames.shape
+    is_numpy = isinstance(frames, np.ndarray)
+    is_pil = isinstance(frames, Image.Image)
+    if is_numpy:
+        shape = frames.shape[:2]
+    elif is_pil:
+        shape = (frames.height, frames.width)
+    else:
+        shape = frames.shape[-2:]
 
     # Select scale_factor. Ensure the crop fits inside the image
-    max_scale_factor = torch.tensor(shape[-2:]).float() / crop_sz
+    max_scale_factor = torch.tensor(shape).float() / crop_sz
     max_scale_factor = max_scale_factor.min().item()
 
     if max_scale_factor < 1.0:
@@ -32,26 +47,77 @@ def random_crop(frames, crop_sz):
 
     assert orig_crop_sz[-2] <= shape[-2] and orig_crop_sz[-1] <= shape[-1], 'Bug in crop size estimation!'
 
-    r1 = random.randint(0, shape[-2] - orig_crop_sz[-2])
-    c1 = random.randint(0, shape[-1] - orig_crop_sz[-1])
+    if rng is None:
+        r1 = random.randint(0, shape[-2] - orig_crop_sz[-2])
+        c1 = random.randint(0, shape[-1] - orig_crop_sz[-1])
+    else:
+        r1 = int(rng.integers(0, shape[-2] - int(orig_crop_sz[-2]) + 1))
+        c1 = int(rng.integers(0, shape[-1] - int(orig_crop_sz[-1]) + 1))
 
     r2 = r1 + orig_crop_sz[0].int().item()
     c2 = c1 + orig_crop_sz[1].int().item()
 
-    frames_crop = frames[:, r1:r2, c1:c2]
+    if is_numpy:
+        frames_crop = frames[r1:r2, c1:c2]
+    elif is_pil:
+        frames_crop = frames.crop((c1, r1, c2, r2))
+    else:
+        frames_crop = frames[..., r1:r2, c1:c2]
 
     # Resize to crop_sz
     if scale_factor < 1.0:
-        frames_crop = F.interpolate(frames_crop.unsqueeze(0), size=crop_sz.int().tolist(), mode='bilinear', align_corners=False).squeeze(0)
+        if is_numpy:
+            # INTER_LINEAR uses the same pixel center convention as bilinear interpolation with align_corners=False
+            frames_crop = cv2.resize(frames_crop, tuple(crop_sz.int().tolist()[::-1]), interpolation=cv2.INTER_LINEAR)
+        elif is_pil:
+            frames_crop = frames_crop.resize(tuple(crop_sz.int().tolist()[::-1]), Image.BILINEAR)
+        else:
+            frames_crop = F.interpolate(frames_crop.unsqueeze(0), size=crop_sz.int().tolist(), mode='bilinear', align_corners=False).squeeze(0)
     return frames_crop
 
 
+def sample_camera_params(image_processing_params=None):
+    """ Samples the parameters of the inverse camera pipeline used by rgb2rawburst, i.e. the color correction matrix
+    and the gains. Returns (rgb2cam, cam2rgb, (rgb_gain, red_gain, blue_gain)), which can be passed to rgb2rawburst as
+    precomputed_aug.
+    """
+    if image_processing_params is None:
+        image_processing_params = {}
+
+    if image_processing_params.get('random_ccm', True):
+        rgb2cam = random_ccm()
+    else:
+        rgb2cam = torch.eye(3).float()
+    cam2rgb = rgb2cam.inverse()
+
+    # Sample gains
+    if image_processing_params.get('random_gains', True):
+        gains = random_gains()
+    else:
+        gains = (1.0, 1.0, 1.0)
+    return rgb2cam, cam2rgb, gains
+
+
+def crop_border(image, burst_transformation_params):
+    """ Removes the border_crop pixels of burst_transformation_params from each side of the [C, H, W] image. The
+    generated burst only covers this inner region. The result is contiguous. """
+    border_crop = (burst_transformation_params or {}).get('border_crop') or 0
+    if border_crop > 0:
+        image = image[:, border_crop:-border_crop, border_crop:-border_crop].contiguous()
+    return image
+
+
 def rgb2rawburst(image, burst_size, downsample_factor=1, burst_transformation_params=None,
-                 image_processing_params=None, interpolation_type='bilinear'):
+                 image_processing_params=None, interpolation_type='bilinear', precomputed_aug=None,
+                 return_border_cropped=False):
     """ Generates a synthetic LR RAW burst from the input image. The input sRGB image is first converted to linear
     sensor space using an inverse camera pipeline. A LR burst is then generated by applying random
     transformations defined by burst_transformation_params to the input image, and downsampling it by the
     downsample_factor. The generated burst is then mosaicekd and corrputed by random noise.
+
+    precomputed_aug is an optional output of sample_camera_params. By default the camera pipeline params are sampled
+    here. If return_border_cropped is True, the returned linear image is cropped to the region covered by the burst
+    (see crop_border).
     """
 
     if image_processing_params is None:
@@ -63,17 +129,9 @@ def rgb2rawburst(image, burst_size, downsample_factor=1, burst_transformation_pa
             image_processing_params[k] = v
 
     # Sample camera pipeline params
-    if image_processing_params['random_ccm']:
-        rgb2cam = random_ccm()
-    else:
-        rgb2cam = torch.eye(3).float()
-    cam2rgb = rgb2cam.inverse()
-
-    # Sample gains
-    if image_processing_params['random_gains']:
-        rgb_gain, red_gain, blue_gain = random_gains()
-    else:
-        rgb_gain, red_gain, blue_gain = (1.0, 1.0, 1.0)
+    if precomputed_aug is None:
+        precomputed_aug = sample_camera_params(image_processing_params)
+    rgb2cam, cam2rgb, (rgb_gain, red_gain, blue_gain) = precomputed_aug
 
     # Approximately inverts global tone mapping.
     use_smoothstep = image_processing_params['smoothstep']
@@ -95,10 +153,11 @@ def rgb2rawburst(image, burst_size, downsample_factor=1, burst_transformation_pa
     image = image.clamp(0.0, 1.0)
 
     # Generate LR burst
-    image_burst_rgb, flow_vectors = single2lrburst(image, burst_size=burst_size,
-                                                   downsample_factor=downsample_factor,
-                                                   transformation_params=burst_transformation_params,
-                                                   interpolation_type=interpolation_type)
+    image_burst_rgb, flow_vectors, homographies = single2lrburst(image, burst_size=burst_size,
+                                                                 downsample_factor=downsample_factor,
+                                                                 transformation_params=burst_transformation_params,
+                                                                 interpolation_type=interpolation_type,
+                                                                 return_homographies=True)
 
     # mosaic
     image_burst = mosaic(image_burst_rgb.clone())
@@ -116,12 +175,16 @@ def rgb2rawburst(image, burst_size, downsample_factor=1, burst_transformation_pa
 
     meta_info = {'rgb2cam': rgb2cam, 'cam2rgb': cam2rgb, 'rgb_gain': rgb_gain, 'red_gain': red_gain,
                  'blue_gain': blue_gain, 'smoothstep': use_smoothstep, 'gamma': use_gamma,
-                 'shot_noise_level': shot_noise_level, 'read_noise_level': read_noise_level}
+                 'shot_noise_level': shot_noise_level, 'read_noise_level': read_noise_level,
+                 'burst_homographies': homographies}
+    if return_border_cropped:
+        image = crop_border(image, burst_transformation_params)
     return image_burst, image, image_burst_rgb, flow_vectors, meta_info
 
 
 def rgb2rawburst_quad(image, burst_size, downsample_factor=1, burst_transformation_params=None,
-                 image_processing_params=None, interpolation_type='bilinear',quad=False):
+                 image_processing_params=None, interpolation_type='bilinear',quad=False, precomputed_aug=None,
+                 return_border_cropped=False):
     """ Generates a synthetic LR RAW burst from the input image. The input sRGB image is first converted to linear
     sensor space using an inverse camera pipeline. A LR burst is then generated by applying random
     transformations defined by burst_transformation_params to the input image, and downsampling it by the
@@ -137,17 +200,9 @@ def rgb2rawburst_quad(image, burst_size, downsample_factor=1, burst_transformati
             image_processing_params[k] = v
 
     # Sample camera pipeline params
-    if image_processing_params['random_ccm']:
-        rgb2cam = random_ccm()
-    else:
-        rgb2cam = torch.eye(3).float()
-    cam2rgb = rgb2cam.inverse()
-
-    # Sample gains
-    if image_processing_params['random_gains']:
-        rgb_gain, red_gain, blue_gain = random_gains()
-    else:
-        rgb_gain, red_gain, blue_gain = (1.0, 1.0, 1.0)
+    if precomputed_aug is None:
+        precomputed_aug = sample_camera_params(image_processing_params)
+    rgb2cam, cam2rgb, (rgb_gain, red_gain, blue_gain) = precomputed_aug
 
     # Approximately inverts global tone mapping.
     use_smoothstep = image_processing_params['smoothstep']
@@ -170,10 +225,11 @@ def rgb2rawburst_quad(image, burst_size, downsample_factor=1, burst_transformati
     # print("image.shape",image.shape)#[3,432,432]
     # exit()
     # Generate LR burst
-    image_burst_rgb, flow_vectors = single2lrburst(image, burst_size=burst_size,
-                                                   downsample_factor=downsample_factor,
-                                                   transformation_params=burst_transformation_params,
-                                                   interpolation_type=interpolation_type)
+    image_burst_rgb, flow_vectors, homographies = single2lrburst(image, burst_size=burst_size,
+                                                                 downsample_factor=downsample_factor,
+                                                                 transformation_params=burst_transformation_params,
+                                                                 interpolation_type=interpolation_type,
+                                                                 return_homographies=True)
 
     # mosaic
     if quad:
@@ -197,7 +253,10 @@ def rgb2rawburst_quad(image, burst_size, downsample_factor=1, burst_transformati
 
     meta_info = {'rgb2cam': rgb2cam, 'cam2rgb': cam2rgb, 'rgb_gain': rgb_gain, 'red_gain': red_gain,
                  'blue_gain': blue_gain, 'smoothstep': use_smoothstep, 'gamma': use_gamma,
-                 'shot_noise_level': shot_noise_level, 'read_noise_level': read_noise_level}
+                 'shot_noise_level': shot_noise_level, 'read_noise_level': read_noise_level,
+                 'burst_homographies': homographies}
+    if return_border_cropped:
+        image = crop_border(image, burst_transformation_params)
     return image_burst, image, image_burst_rgb, flow_vectors, meta_info
 
 
@@ -228,9 +287,14 @@ def get_tmat(image_shape, translation, theta, shear_values, scale_factors):
 
 
 def single2lrburst(image, burst_size, downsample_factor=1, transformation_params=None,
-                   interpolation_type='bilinear'):
+                   interpolation_type='bilinear', return_homographies=False):
     """ Generates a burst of size burst_size from the input image by applying random transformations defined by
     transformation_params, and downsampling the resulting burst by downsample_factor.
+
+    If return_homographies is True, a tensor of shape [burst_size, 3, 3] is returned in addition. The i'th matrix maps
+    pixel coordinates of the base (first) image to pixel coordinates of the i'th image, both in the output LR space.
+    Warping the i'th image with cv2.warpPerspective(..., flags=cv2.WARP_INVERSE_MAP) using it aligns it to the base
+    image.
     """
 
     if interpolation_type == 'bilinear':
@@ -249,6 +313,7 @@ def single2lrburst(image, burst_size, downsample_factor=1, transformation_params
 
     burst = []
     sample_pos_inv_all = []
+    t_mat_all = []
 
     rvs, cvs = torch.meshgrid([torch.arange(0, image.shape[0]),
                                torch.arange(0, image.shape[1])])
@@ -296,6 +361,7 @@ def single2lrburst(image, burst_size, downsample_factor=1, transformation_params
         # Generate a affine transformation matrix corresponding to the sampled parameters
         t_mat = get_tmat((image.shape[0], image.shape[1]), translation, theta, shear_factor, scale_factor)
         t_mat_tensor = torch.from_numpy(t_mat)
+        t_mat_all.append(np.concatenate((t_mat, np.array([[0.0, 0.0, 1.0]]))))
 
         # Apply the sampled affine transformation
         image_t = cv2.warpAffine(image, t_mat, output_sz, flags=interpolation,
@@ -335,4 +401,16 @@ def single2lrburst(image, burst_size, downsample_factor=1, transformation_params
     # Compute the flow vectors to go from the i'th burst image to the base image
     flow_vectors = sample_pos_inv_all - sample_pos_inv_all[:, :1, ...]
 
+    if return_homographies:
+        # lr2hr maps LR pixel coordinates to coordinates in the transformed HR images, undoing the downsampling
+        # (pixel centers) and the border crop. The i'th LR image samples the input image at t_mat_i^-1 * lr2hr * x
+        border_crop = transformation_params.get('border_crop') or 0
+        offset = (downsample_factor - 1) / 2.0 + border_crop
+        lr2hr = np.array([[downsample_factor, 0.0, offset],
+                          [0.0, downsample_factor, offset],
+                          [0.0, 0.0, 1.0]])
+        base2hr = np.linalg.inv(t_mat_all[0]) @ lr2hr
+        homographies = np.stack([np.linalg.inv(lr2hr) @ t_mat @ base2hr for t_mat in t_mat_all])
+        return burst_images, flow_vectors, torch.from_numpy(homographies).float()
+
     return burst_images, flow_vectors
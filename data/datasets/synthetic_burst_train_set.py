@@ -1,128 +1,275 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import torch
 import numpy as np
 from PIL import Image
-from data.data_processing.synthetic_burst_generation import rgb2rawburst, rgb2rawburst_quad, random_crop #syn_burst_utils
-import torchvision.transforms as tfm
+from data.data_processing.synthetic_burst_generation import rgb2rawburst, rgb2rawburst_quad, random_crop, \
+    sample_camera_params #syn_burst_utils
+from data.utils.data_format_utils import FastToTensor
 import cv2
-import colour_demosaicing
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+_ALIGN_POOL = None
+_ALIGN_POOL_PID = None
+
+
+def get_align_pool():
+    """ Thread pool used to align the frames of a burst in parallel. OpenCV releases the GIL inside its kernels, so
+    the frames are processed concurrently. The pool is created lazily, once per process, so that each DataLoader
+    worker owns its threads instead of inheriting a forked copy of the parent's pool. The number of threads is set
+    by the ALIGN_THREADS environment variable (default 4)."""
+    global _ALIGN_POOL, _ALIGN_POOL_PID
+    if _ALIGN_POOL is None or _ALIGN_POOL_PID != os.getpid():
+        _ALIGN_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get('ALIGN_THREADS', 4)))
+        _ALIGN_POOL_PID = os.getpid()
+    return _ALIGN_POOL
+
+
+def find_transform_ecc(im1_gray, im2_gray, warp_matrix, warp_mode, criteria, downscale=1):
+    """ cv2.findTransformECC on the pair downscaled by downscale. The burst motion is small, so the warp can be
+    estimated at a lower resolution, and the ECC cost scales with the number of pixels. The initial warp_matrix and
+    the returned one are in full resolution pixel coordinates. Raises cv2.error if ECC does not converge."""
+    s = downscale
+    if s > 1:
+        dsize = (im1_gray.shape[1] // s, im1_gray.shape[0] // s)
+        im1_gray = cv2.resize(im1_gray, dsize, interpolation=cv2.INTER_AREA)
+        im2_gray = cv2.resize(im2_gray, dsize, interpolation=cv2.INTER_AREA)
+        # Conjugate with the map from downscaled to full resolution pixel coordinates (pixel centers). An affine
+        # warp_matrix is the first 2 rows of the 3x3 matrix
+        small2full = np.array([[s, 0.0, (s - 1) / 2.0],
+                               [0.0, s, (s - 1) / 2.0],
+                               [0.0, 0.0, 1.0]], dtype=np.float32)
+        full2small = np.linalg.inv(small2full)
+        rows = warp_matrix.shape[0]
+        warp_3x3 = np.eye(3, dtype=np.float32)
+        warp_3x3[:rows] = warp_matrix
+        warp_matrix = (full2small @ warp_3x3 @ small2full)[:rows].astype(np.float32)
+    (cc, warp_matrix) = cv2.findTransformECC(im1_gray, im2_gray, warp_matrix, warp_mode, criteria)
+    if s > 1:
+        warp_3x3 = np.eye(3, dtype=np.float32)
+        warp_3x3[:rows] = warp_matrix
+        warp_matrix = (small2full @ warp_3x3 @ full2small)[:rows].astype(np.float32)
+    return cc, warp_matrix
+
+
+def pyramid_ecc(im1_gray, im2_gray, warp_matrix_init, warp_mode, criteria, criteria_coarse):
+    """ Coarse-to-fine cv2.findTransformECC. A translation is first estimated on the pair downscaled with cv2.pyrDown,
+    where ECC is cheaper and less likely to get stuck, and then used to initialize ECC with warp_mode at full
+    resolution, which then needs fewer iterations. Raises cv2.error if ECC does not converge."""
+    shift = np.eye(2, 3, dtype=np.float32)
+    (_, shift) = cv2.findTransformECC(cv2.pyrDown(im1_gray), cv2.pyrDown(im2_gray), shift, cv2.MOTION_TRANSLATION,
+                                      criteria_coarse)
+    # pyrDown keeps every other pixel, so the translation doubles at full resolution
+    warp_matrix = warp_matrix_init.copy()
+    warp_matrix[:2, 2] += 2.0 * shift[:, 2]
+    return cv2.findTransformECC(im1_gray, im2_gray, warp_matrix, warp_mode, criteria)
+
+
+def phase_correlate_warp(im1_gray, im2_gray, warp_matrix_init, window=None):
+    """ Estimates the translation between im1_gray and im2_gray with cv2.phaseCorrelate, i.e. with a single FFT pair
+    instead of the iterations of ECC. Returns the peak response of the correlation (low values mean that the shift is
+    unreliable) and warp_matrix_init with the translation added, in the convention of cv2.findTransformECC. window is
+    an optional cv2.createHanningWindow. """
+    # The images are made zero mean, otherwise the border of the (small) images dominates the correlation
+    im1_gray = im1_gray - im1_gray.mean()
+    im2_gray = im2_gray - im2_gray.mean()
+    (dx, dy), response = cv2.phaseCorrelate(im1_gray, im2_gray, window)
+    warp_matrix = warp_matrix_init.copy()
+    warp_matrix[0, 2] += dx
+    warp_matrix[1, 2] += dy
+    return response, warp_matrix
+
+
+class InverseCompositionalECC:
+    """ Homography ECC in the inverse compositional formulation. cv2.findTransformECC differentiates the warped input
+    image in every iteration of every call, while here the linearization is done on the template: its gradients, the
+    Jacobian of the homography and the Hessian are computed once in __init__ and shared by all the frames that are
+    registered against it, and an iteration only warps the input and solves a precomputed 8x8 system.
+
+    Both images are smoothed as in findTransformECC, and the criterion is the same correlation coefficient of the
+    zero-mean images. It is evaluated on the template without a border of margin pixels, which has to be larger than
+    the motion so that the warped input covers it.
+    """
+    def __init__(self, im1_gray, margin=4, gauss_size=5):
+        self.gauss_size = gauss_size
+        template = cv2.GaussianBlur(im1_gray, (gauss_size, gauss_size), 0)
+        h, w = template.shape
+        self.roi = (slice(margin, h - margin), slice(margin, w - margin))
+        self.roi_shape = (h - 2 * margin, w - 2 * margin)
+        # The homography is parametrized around the image center, which keeps the Hessian well conditioned
+        cx, cy = (w - 1) / 2.0, (h - 1) / 2.0
+        self.center = np.array([[1.0, 0.0, cx], [0.0, 1.0, cy], [0.0, 0.0, 1.0]])
+        self.center_inv = np.linalg.inv(self.center)
+        # Maps the pixels of the warped region, which is warped on its own, to the pixels of the template
+        self.center_inv_roi = self.center_inv @ np.array([[1.0, 0.0, margin], [0.0, 1.0, margin], [0.0, 0.0, 1.0]])
+        yy, xx = np.mgrid[self.roi].astype(np.float32)
+        x = (xx - cx).ravel()
+        y = (yy - cy).ravel()
+        # Same gradient filter as findTransformECC
+        gx = (cv2.Sobel(template, cv2.CV_32F, 1, 0) * 0.125)[self.roi].ravel()
+        gy = (cv2.Sobel(template, cv2.CV_32F, 0, 1) * 0.125)[self.roi].ravel()
+        gxy = gx * x + gy * y
+        # Steepest descent images, i.e. the template gradient times the Jacobian of the homography at the identity.
+        # Making them zero mean accounts for the mean subtraction of the criterion
+        sd = np.stack([gx * x, gx * y, gx, gy * x, gy * y, gy, -x * gxy, -y * gxy])
+        sd -= sd.mean(axis=1, keepdims=True)
+        self.sd = sd
+        self.hessian_inv = np.linalg.pinv(sd.astype(np.float64) @ sd.T.astype(np.float64))
+        template = template[self.roi].ravel()
+        self.template = template - template.mean()
+        self.template_norm = np.linalg.norm(self.template)
+
+    def find_transform(self, im2_gray, warp_matrix, criteria):
+        """ Same as cv2.findTransformECC(im1_gray, im2_gray, warp_matrix, cv2.MOTION_HOMOGRAPHY, criteria): returns
+        the correlation coefficient and the 3x3 warp_matrix, such that im2_gray warped with it and WARP_INVERSE_MAP
+        matches im1_gray. Instead of raising cv2.error, the correlation coefficient is 0 if the images are flat. """
+        criteria_type, max_iterations, eps = criteria
+        if not criteria_type & cv2.TERM_CRITERIA_COUNT:
+            max_iterations = 200
+        if not criteria_type & cv2.TERM_CRITERIA_EPS:
+            eps = -1.0
+        if self.template_norm == 0:
+            return 0.0, warp_matrix
+        image = cv2.GaussianBlur(im2_gray, (self.gauss_size, self.gauss_size), 0)
+        warp_centered = self.center_inv @ warp_matrix @ self.center
+        # Only the region away from the border is warped, into arrays that are reused by all the iterations
+        warped_roi = np.empty(self.roi_shape, dtype=np.float32)
+        warped = warped_roi.reshape(-1)
+        error = np.empty_like(warped)
+        dsize = (self.roi_shape[1], self.roi_shape[0])
+        cc = last_cc = 0.0
+        for _ in range(max_iterations):
+            warp = self.center @ warp_centered @ self.center_inv_roi
+            cv2.warpPerspective(image, warp, dsize, dst=warped_roi, flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP,
+                                borderMode=cv2.BORDER_REPLICATE)
+            warped -= warped.mean()
+            warped_norm = np.sqrt(warped @ warped)
+            if warped_norm == 0:
+                return 0.0, warp_matrix
+            cc = float(warped @ self.template) / (warped_norm * self.template_norm)
+            if abs(cc - last_cc) < eps:
+                break
+            last_cc = cc
+            # Gauss-Newton step on the template side, which is then inverted and composed with the current warp
+            np.multiply(warped, self.template_norm / warped_norm, out=error)
+            error -= self.template
+            dp = self.hessian_inv @ (self.sd @ error)
+            warp_step = np.array([[1.0 + dp[0], dp[1], dp[2]],
+                                  [dp[3], 1.0 + dp[4], dp[5]],
+                                  [dp[6], dp[7], 1.0]])
+            warp_centered = warp_centered @ np.linalg.inv(warp_step)
+            warp_centered /= warp_centered[2, 2]
+        warp = self.center @ warp_centered @ self.center_inv
+        return cc, (warp / warp[2, 2]).astype(np.float32)
+
+
+def ncc_precheck(im1_gray, im2_gray, size=32):
+    """ Normalized cross-correlation of the pair downscaled to size x size. This is a cheap test to run before
+    find_transform_ecc: on frames that are too dissimilar, ECC would run all its iterations only to fail."""
+    im1_small = cv2.resize(im1_gray, (size, size), interpolation=cv2.INTER_AREA)
+    im2_small = cv2.resize(im2_gray, (size, size), interpolation=cv2.INTER_AREA)
+    return cv2.matchTemplate(im1_small, im2_small, cv2.TM_CCOEFF_NORMED)[0, 0]
+
+
+# Defaults of the ecc_min_ncc and ecc_min_cc settings of the aligned datasets, see _ecc_warp. ECC is skipped for
+# frames whose ncc_precheck with the base frame is lower than ECC_MIN_NCC, and ECC results with a lower correlation
+# coefficient than ECC_MIN_CC are treated as not converged. Converged warps of the noisy RAW planes reach 0.7-0.95
+ECC_MIN_NCC = 0.3
+ECC_MIN_CC = 0.5
+
+
+def _ecc_warp(im1_gray, im2_gray, warp_matrix_init, warp_mode, criteria, downscale=1, min_ncc=None,
+              criteria_coarse=None, min_cc=None):
+    """ Estimates the warp between the single channel images im1_gray and im2_gray with ECC. If criteria_coarse is
+    given, ECC is initialized with a translation estimated at half resolution (see pyramid_ecc), otherwise with
+    warp_matrix_init. Returns None if ECC fails, if the ncc_precheck of the pair is below min_ncc, or if the
+    correlation coefficient reached by ECC is below min_cc. """
+    if min_ncc is not None and ncc_precheck(im1_gray, im2_gray) < min_ncc:
+        return None
+    try:
+        # Run the ECC algorithm. The results are stored in warp_matrix.
+        if criteria_coarse is not None:
+            (cc, warp_matrix) = pyramid_ecc(im1_gray, im2_gray, warp_matrix_init, warp_mode, criteria,
+                                            criteria_coarse)
+        else:
+            (cc, warp_matrix) = find_transform_ecc(im1_gray, im2_gray, warp_matrix_init.copy(), warp_mode,
+                                                   criteria, downscale=downscale)
+    except cv2.error:
+        # raised when ECC diverges
+        return None
+    if min_cc is not None and cc < min_cc:
+        return None
+    return warp_matrix
+
+
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def _flatten_raw_numba(im_raw_4ch, im_out):
+        _, h, w = im_raw_4ch.shape
+        for i in range(h):
+            for j in range(w):
+                im_out[2 * i, 2 * j] = im_raw_4ch[0, i, j]
+                im_out[2 * i, 2 * j + 1] = im_raw_4ch[1, i, j]
+                im_out[2 * i + 1, 2 * j] = im_raw_4ch[2, i, j]
+                im_out[2 * i + 1, 2 * j + 1] = im_raw_4ch[3, i, j]
+else:
+    _flatten_raw_numba = None
 
 
 def flatten_raw_image(im_raw_4ch):
     """ unpack a 4-channel tensor into a single channel bayer image"""
+    _, h, w = im_raw_4ch.shape
+    # Channel 2 * dy + dx goes to the pixels [dy::2, dx::2], i.e. a pixel shuffle with factor 2, done as a single
+    # copy: [4, H, W] -> [dy, dx, H, W] -> [H, dy, W, dx] -> [2H, 2W]
     if isinstance(im_raw_4ch, np.ndarray):
-        im_out = np.zeros_like(im_raw_4ch, shape=(im_raw_4ch.shape[1] * 2, im_raw_4ch.shape[2] * 2))
+        if _flatten_raw_numba is not None:
+            # The compiled loop avoids the strided copy of the transposed view (and releases the GIL)
+            im_out = np.empty((h * 2, w * 2), dtype=im_raw_4ch.dtype)
+            _flatten_raw_numba(im_raw_4ch, im_out)
+            return im_out
+        im_out = im_raw_4ch.reshape(2, 2, h, w).transpose(2, 0, 3, 1).reshape(h * 2, w * 2)
     elif isinstance(im_raw_4ch, torch.Tensor):
-        im_out = torch.zeros((im_raw_4ch.shape[1] * 2, im_raw_4ch.shape[2] * 2), dtype=im_raw_4ch.dtype)
+        im_out = im_raw_4ch.reshape(2, 2, h, w).permute(2, 0, 3, 1).reshape(h * 2, w * 2)
     else:
         raise Exception
 
-    im_out[0::2, 0::2] = im_raw_4ch[0, :, :]
-    im_out[0::2, 1::2] = im_raw_4ch[1, :, :]
-    im_out[1::2, 0::2] = im_raw_4ch[2, :, :]
-    im_out[1::2, 1::2] = im_raw_4ch[3, :, :]
-
     return im_out
 
 
-class SyntheticBurst(torch.utils.data.Dataset):
-    """ Synthetic burst dataset for joint denoising, demosaicking, and super-resolution. RAW Burst sequences are
-    synthetically generated on the fly as follows. First, a single image is loaded from the base_dataset. The sampled
-    image is converted to linear sensor space using the inverse camera pipeline employed in [1]. A burst
-    sequence is then generated by adding random translations and rotations to the converted image. The generated burst
-    is then converted is then mosaicked, and corrupted by random noise to obtain the RAW burst.
-
-    [1] Unprocessing Images for Learned Raw Denoising, Brooks, Tim and Mildenhall, Ben and Xue, Tianfan and Chen,
-    Jiawen and Sharlet, Dillon and Barron, Jonathan T, CVPR 2019
-    """
-    def __init__(self, base_dataset, burst_size=8, crop_sz=384, transform=tfm.ToTensor()):
-        self.base_dataset = base_dataset
-
-        self.burst_size = burst_size
-        self.crop_sz = crop_sz
-        self.transform = transform
-
-        self.downsample_factor = 4
-        self.burst_transformation_params = {'max_translation': 24.0,
-                                            'max_rotation': 1.0,
-                                            'max_shear': 0.0,
-                                            'max_scale': 0.0,
-                                            'border_crop': 24}
-
-        self.image_processing_params = {'random_ccm': True, 'random_gains': True, 'smoothstep': True,
-                                        'gamma': True,
-                                        'add_noise': True}
-        self.interpolation_type = 'bilinear'
-
-    def __len__(self):
-        return len(self.base_dataset)
-
-    def __getitem__(self, index):
-        """ Generates a synthetic burst
-        args:
-            index: Index of the image in the base_dataset used to generate the burst
-
-        returns:
-            burst: Generated LR RAW burst, a torch tensor of shape
-                   [burst_size, 4, self.crop_sz / (2*self.downsample_factor), self.crop_sz / (2*self.downsample_factor)]
-                   The 4 channels correspond to 'R', 'G', 'G', and 'B' values in the RGGB bayer mosaick.
-                   The extra factor 2 in the denominator (2*self.downsample_factor) corresponds to the mosaicking
-                   operation.
-
-            frame_gt: The HR RGB ground truth in the linear sensor space, a torch tensor of shape
-                      [3, self.crop_sz, self.crop_sz]
-
-            flow_vectors: The ground truth flow vectors between a burst image and the base image (i.e. the first image in the burst).
-                          The flow_vectors can be used to warp the burst images to the base frame, using the 'warp'
-                          function in utils.warp package.
-                          flow_vectors is torch tensor of shape
-                          [burst_size, 2, self.crop_sz / self.downsample_factor, self.crop_sz / self.downsample_factor].
-                          Note that the flow_vectors are in the LR RGB space, before mosaicking. Hence it has twice
-                          the number of rows and columns, compared to the output burst.
-
-                          NOTE: The flow_vectors are only available during training for the purpose of using any
-                                auxiliary losses if needed. The flow_vectors will NOT be provided for the bursts in the
-                                test set
-
-            meta_info: A dictionary containing the parameters used to generate the synthetic burst.
-        """
-        frame = self.base_dataset[index]
-
-        # Augmentation, e.g. convert to tensor
-        if self.transform is not None:
-            # frame = Image.fromarray(frame)
-            frame = self.transform(frame)
-
-        # Extract a random crop from the image
-        crop_sz = self.crop_sz + 2 * self.burst_transformation_params.get('border_crop', 0)
-        frame_crop = random_crop(frame, crop_sz)
-
-        # Generate RAW burst
-        burst, frame_gt, burst_rgb, flow_vectors, meta_info = rgb2rawburst(frame_crop,
-                                                                           self.burst_size,
-                                                                           self.downsample_factor,
-                                                                           burst_transformation_params=self.burst_transformation_params,
-                                                                           image_processing_params=self.image_processing_params,
-                                                                           interpolation_type=self.interpolation_type
-                                                                           )
-
-        if self.burst_transformation_params.get('border_crop') is not None:
-            border_crop = self.burst_transformation_params.get('border_crop')
-            frame_gt = frame_gt[:, border_crop:-border_crop, border_crop:-border_crop]
-
-        return burst, frame_gt, burst_rgb, flow_vectors, meta_info
-
+def raw4_to_rgb(im_raw_4ch):
+    """ Demosaics a [4, H, W] RGGB tensor in [0, 1] to a [3, 2H, 2W] RGB tensor (bilinear, with OpenCV)"""
+    # OpenCV only demosaics integer images, so the planes are quantized to uint16 before they are interleaved
+    bayer = flatten_raw_image((np.clip(im_raw_4ch.numpy(), 0.0, 1.0) * 65535.0 + 0.5).astype(np.uint16))
+    # OpenCV names the Bayer patterns by the second row, so the RGGB mosaic is COLOR_BayerBG2RGB
+    im_rgb = cv2.cvtColor(bayer, cv2.COLOR_BayerBG2RGB)
+    # HWC uint16 -> CHW float32 in a single copy
+    return torch.from_numpy(np.ascontiguousarray(im_rgb.transpose(2, 0, 1), dtype=np.float32)).div_(65535.0)
 
-class SyntheticBurstRGB(torch.utils.data.Dataset):
-    """ Synthetic burst dataset for joint denoising, demosaicking, and super-resolution. RAW Burst sequences are
-    synthetically generated on the fly as follows. First, a single image is loaded from the base_dataset. The sampled
-    image is converted to linear sensor space using the inverse camera pipeline employed in [1]. A burst
-    sequence is then generated by adding random translations and rotations to the converted image. The generated burst
-    is then converted is then mosaicked, and corrupted by random noise to obtain the RAW burst.
 
-    [1] Unprocessing Images for Learned Raw Denoising, Brooks, Tim and Mildenhall, Ben and Xue, Tianfan and Chen,
-    Jiawen and Sharlet, Dillon and Barron, Jonathan T, CVPR 2019
+class _SyntheticBurstBase(torch.utils.data.Dataset):
+    """ Shared implementation of the synthetic burst datasets below. __getitem__ loads and crops an image from the
+    base_dataset and generates the burst with rgb2rawburst. Subclasses only set the default camera pipeline settings
+    and post-process the generated burst, e.g. by aligning it.
     """
-    def __init__(self, base_dataset, burst_size=8, crop_sz=384, transform=tfm.ToTensor()):
+    default_image_processing_params = {'random_ccm': True, 'random_gains': True, 'smoothstep': True,
+                                       'gamma': True,
+                                       'add_noise': True}
+    # Number of precomputed camera pipeline params (CCM and gains) the bursts draw from
+    camera_params_pool_size = 1024
+
+    def __init__(self, base_dataset, burst_size=8, crop_sz=384, transform=FastToTensor(),
+                 image_processing_params=None, output_dtype=None):
+        """ output_dtype is an optional floating point dtype (e.g. torch.float16) the returned float tensors are
+        cast to. This halves the size of the samples sent from the DataLoader workers and copied to the GPU,
+        to_device_float casts them back to float32 on the device.
+        """
         self.base_dataset = base_dataset
 
         self.burst_size = burst_size
@@ -135,11 +282,134 @@ class SyntheticBurstRGB(torch.utils.data.Dataset):
                                             'max_shear': 0.0,
                                             'max_scale': 0.0,
                                             'border_crop': 24}
-
-        self.image_processing_params = {'random_ccm': False, 'random_gains': False, 'smoothstep': False,
-                                        'gamma': False,
-                                        'add_noise': False}
+        # Invariants of __getitem__
+        self._border_crop = self.burst_transformation_params.get('border_crop') or 0
+        self._crop_sz_with_border = self.crop_sz + 2 * self._border_crop
+        # Without random motion all frames of the burst are already aligned
+        self._static_burst = all(self.burst_transformation_params.get(k, 0.0) == 0
+                                 for k in ('max_translation', 'max_rotation', 'max_shear', 'max_ar_factor',
+                                           'max_scale'))
+
+        if image_processing_params is None:
+            image_processing_params = self.default_image_processing_params
+        self.image_processing_params = dict(image_processing_params)
         self.interpolation_type = 'bilinear'
+        self.output_dtype = output_dtype
+
+        # Generator for the crop positions and the camera parameters, created on first use in every process, see _rng
+        self._rng_generator = None
+        self._rng_pid = None
+
+        # Sampling a CCM and inverting it costs more than drawing it from a pool. The pool is shared by the workers,
+        # which draw different entries since each of them has its own _rng
+        if self.image_processing_params['random_ccm'] or self.image_processing_params['random_gains']:
+            self._camera_params_pool = [sample_camera_params(self.image_processing_params)
+                                        for _ in range(self.camera_params_pool_size)]
+        else:
+            self._camera_params_pool = [sample_camera_params(self.image_processing_params)]
+
+        # Set by build_cache
+        self._cache = None
+
+    def __getstate__(self):
+        # Per-thread scratch buffers can not be pickled, e.g. when the DataLoader workers are spawned
+        state = self.__dict__.copy()
+        state.pop('_scratch', None)
+        # The memory map is re-opened by each process instead of pickling the mapped data
+        state.pop('_cache_mmap', None)
+        return state
+
+    def _scratch_buffer(self, name, shape, dtype=np.float32):
+        """ Returns an uninitialized array which is allocated once per thread and reused across samples. DataLoader
+        workers are long-lived, so this avoids re-allocating the staging arrays for every burst. """
+        scratch = self.__dict__.get('_scratch')
+        if scratch is None:
+            scratch = self.__dict__.setdefault('_scratch', threading.local())
+        buf = getattr(scratch, name, None)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            setattr(scratch, name, buf)
+        return buf
+
+    def build_cache(self, cache_path):
+        """ Decodes every image of the base_dataset once and stores them in a single file at cache_path, which is
+        memory-mapped by __getitem__ instead of decoding the image again for every sample. After the first epoch the
+        frames are served from the OS page cache. The frames are stored as returned by the base_dataset (e.g. uint8
+        HWC images from cv2.imread), so the random crop is still taken before the transform. An existing cache at
+        cache_path is reused.
+        """
+        index_path = cache_path + '.index.npz'
+        if not os.path.isfile(index_path):
+            offsets, shapes, dtype = [], [], None
+            offset = 0
+            # The frames have different sizes, so they are appended one after the other and located by their offset
+            with open(cache_path + '.tmp', 'wb') as f:
+                for i in range(len(self.base_dataset)):
+                    frame = np.ascontiguousarray(self.base_dataset[i])
+                    if dtype is None:
+                        dtype = frame.dtype
+                    assert frame.dtype == dtype, 'All images of the base_dataset must have the same dtype'
+                    frame.tofile(f)
+                    offsets.append(offset)
+                    shapes.append(frame.shape)
+                    offset += frame.nbytes
+            os.replace(cache_path + '.tmp', cache_path)
+            # The index is written last, so that an interrupted build is not mistaken for a complete cache
+            np.savez(index_path, offsets=np.array(offsets, dtype=np.int64), shapes=np.array(shapes, dtype=np.int64),
+                     dtype=np.array(dtype.str))
+
+        index = np.load(index_path)
+        assert len(index['offsets']) == len(self.base_dataset), 'Cache {} does not match the base_dataset'.format(
+            cache_path)
+        self._cache = {'path': cache_path, 'offsets': index['offsets'], 'shapes': index['shapes'],
+                       'dtype': np.dtype(str(index['dtype']))}
+        self.__dict__.pop('_cache_mmap', None)
+
+    def _load_frame(self, index):
+        if self._cache is None:
+            return self.base_dataset[index]
+
+        mmap = self.__dict__.get('_cache_mmap')
+        if mmap is None:
+            # copy-on-write, so that the frames can be wrapped by torch.from_numpy without read-only warnings
+            mmap = self._cache_mmap = np.memmap(self._cache['path'], dtype=np.uint8, mode='c')
+        offset = self._cache['offsets'][index]
+        shape = tuple(self._cache['shapes'][index])
+        dtype = self._cache['dtype']
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return mmap[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    @property
+    def _rng(self):
+        """ numpy Generator for the random crops and camera parameters. It is seeded on first use in every process,
+        from the worker seed in a DataLoader worker and from torch.initial_seed() otherwise, so torch.manual_seed makes
+        the samples reproducible, and the workers neither share the state inherited from the main process nor repeat
+        their crops in the next epoch. This does not depend on worker_init_fn, and also holds for a wrapped dataset
+        (e.g. a Subset). """
+        if self._rng_generator is None or self._rng_pid != os.getpid():
+            worker_info = torch.utils.data.get_worker_info()
+            seed = worker_info.seed if worker_info is not None else torch.initial_seed()
+            self._rng_generator = np.random.default_rng(seed % 2 ** 32)
+            self._rng_pid = os.getpid()
+        return self._rng_generator
+
+    @staticmethod
+    def worker_init_fn(worker_id):
+        """ worker_init_fn for the DataLoader. Generating a burst is expensive, so these datasets should be loaded
+        with worker processes that are kept alive across epochs, e.g.
+
+            DataLoader(dataset, num_workers=N, persistent_workers=True, pin_memory=True, prefetch_factor=4,
+                       worker_init_fn=dataset.worker_init_fn)
+
+        persistent_workers also keeps the per-worker scratch buffers (see _scratch_buffer) alive between epochs.
+        The random generator of the workers does not depend on this function, see _rng.
+        """
+        # Each worker is already one of N parallel processes. Without this, OpenCV and torch each start a thread pool
+        # with one thread per core in every worker and the workers fight over the CPU. setNumThreads(0) makes
+        # OpenCV run its functions sequentially; the frames of a burst are still aligned in parallel on the threads
+        # of get_align_pool(), which does not nest inside OpenCV's own pool
+        cv2.setNumThreads(0)
+        torch.set_num_threads(1)
 
     def __len__(self):
         return len(self.base_dataset)
@@ -172,35 +442,60 @@ class SyntheticBurstRGB(torch.utils.data.Dataset):
                                 test set
 
             meta_info: A dictionary containing the parameters used to generate the synthetic burst.
+
+        Subclasses return a different sample by overriding _postprocess, which receives the values above.
         """
-        frame = self.base_dataset[index]
+        frame = self._load_frame(index)
+
+        # Extract a random crop from the image. The crop is taken before the transform, so that only the crop and
+        # not the full image is converted to a tensor
+        frame_crop = random_crop(frame, self._crop_sz_with_border, rng=self._rng)
 
         # Augmentation, e.g. convert to tensor
         if self.transform is not None:
-            # frame = Image.fromarray(frame)
-            frame = self.transform(frame)
-
-        # Extract a random crop from the image
-        crop_sz = self.crop_sz + 2 * self.burst_transformation_params.get('border_crop', 0)
-        frame_crop = random_crop(frame, crop_sz)
+            # frame_crop = Image.fromarray(frame_crop)
+            frame_crop = self.transform(frame_crop)
 
         # Generate RAW burst
-        burst, frame_gt, burst_rgb, flow_vectors, meta_info = rgb2rawburst(frame_crop,
-                                                                           self.burst_size,
-                                                                           self.downsample_factor,
-                                                                           burst_transformation_params=self.burst_transformation_params,
-                                                                           image_processing_params=self.image_processing_params,
-                                                                           interpolation_type=self.interpolation_type
-                                                                           )
-
-        if self.burst_transformation_params.get('border_crop') is not None:
-            border_crop = self.burst_transformation_params.get('border_crop')
-            frame_gt = frame_gt[:, border_crop:-border_crop, border_crop:-border_crop]
+        # frame_gt is already cropped to the region covered by the burst
+        burst, frame_gt, burst_rgb, flow_vectors, meta_info = self._generate_burst(frame_crop)
+
+        data = self._postprocess(burst, frame_gt, burst_rgb, flow_vectors, meta_info)
+        if self.output_dtype is not None:
+            data = self._cast_output(data)
+        return data
 
+    def _cast_output(self, data):
+        """ Casts the float tensors of the sample (a dict or a tuple) to output_dtype. meta_info and the warps
+        ('LR_warps') are not cast """
+        def cast(v):
+            if torch.is_tensor(v) and v.is_floating_point():
+                return v.to(self.output_dtype)
+            return v
+
+        if isinstance(data, dict):
+            return {k: v if k == 'LR_warps' else cast(v) for k, v in data.items()}
+        return tuple(cast(v) for v in data)
+
+    def _generate_burst(self, frame_crop):
+        return rgb2rawburst(frame_crop,
+                            self.burst_size,
+                            self.downsample_factor,
+                            burst_transformation_params=self.burst_transformation_params,
+                            image_processing_params=self.image_processing_params,
+                            interpolation_type=self.interpolation_type,
+                            precomputed_aug=self._sample_camera_params(),
+                            return_border_cropped=True
+                            )
+
+    def _sample_camera_params(self):
+        return self._camera_params_pool[self._rng.integers(len(self._camera_params_pool))]
+
+    def _postprocess(self, burst, frame_gt, burst_rgb, flow_vectors, meta_info):
         return burst, frame_gt, burst_rgb, flow_vectors, meta_info
 
 
-class SyntheticBurstRGBAligned(torch.utils.data.Dataset):
+class SyntheticBurst(_SyntheticBurstBase):
     """ Synthetic burst dataset for joint denoising, demosaicking, and super-resolution. RAW Burst sequences are
     synthetically generated on the fly as follows. First, a single image is loaded from the base_dataset. The sampled
     image is converted to linear sensor space using the inverse camera pipeline employed in [1]. A burst
@@ -210,416 +505,414 @@ class SyntheticBurstRGBAligned(torch.utils.data.Dataset):
     [1] Unprocessing Images for Learned Raw Denoising, Brooks, Tim and Mildenhall, Ben and Xue, Tianfan and Chen,
     Jiawen and Sharlet, Dillon and Barron, Jonathan T, CVPR 2019
     """
-    def __init__(self, base_dataset, burst_size=8, crop_sz=384, transform=tfm.ToTensor()):
-        self.base_dataset = base_dataset
-
-        self.burst_size = burst_size
-        self.crop_sz = crop_sz
-        self.transform = transform
 
-        self.downsample_factor = 4
-        self.burst_transformation_params = {'max_translation': 24.0,
-                                            'max_rotation': 1.0,
-                                            'max_shear': 0.0,
-                                            'max_scale': 0.0,
-                                            'border_crop': 24}
 
-        self.image_processing_params = {'random_ccm': False, 'random_gains': False, 'smoothstep': False,
-                                        'gamma': False,
-                                        'add_noise': False}
-        self.interpolation_type = 'bilinear'
-
-    def __len__(self):
-        return len(self.base_dataset)
-
-    def __getitem__(self, index):
-        """ Generates a synthetic burst
-        args:
-            index: Index of the image in the base_dataset used to generate the burst
-
-        returns:
-            burst: Generated LR RAW burst, a torch tensor of shape
-                   [burst_size, 4, self.crop_sz / (2*self.downsample_factor), self.crop_sz / (2*self.downsample_factor)]
-                   The 4 channels correspond to 'R', 'G', 'G', and 'B' values in the RGGB bayer mosaick.
-                   The extra factor 2 in the denominator (2*self.downsample_factor) corresponds to the mosaicking
-                   operation.
-
-            frame_gt: The HR RGB ground truth in the linear sensor space, a torch tensor of shape
-                      [3, self.crop_sz, self.crop_sz]
-
-            flow_vectors: The ground truth flow vectors between a burst image and the base image (i.e. the first image in the burst).
-                          The flow_vectors can be used to warp the burst images to the base frame, using the 'warp'
-                          function in utils.warp package.
-                          flow_vectors is torch tensor of shape
-                          [burst_size, 2, self.crop_sz / self.downsample_factor, self.crop_sz / self.downsample_factor].
-                          Note that the flow_vectors are in the LR RGB space, before mosaicking. Hence it has twice
-                          the number of rows and columns, compared to the output burst.
+class SyntheticBurstRGB(_SyntheticBurstBase):
+    """ Same as SyntheticBurst, but the camera pipeline is disabled (no random CCM / gains, tone mapping, gamma or
+    noise), i.e. burst_rgb is a clean, shifted and downsampled copy of the sRGB input image.
+    """
+    default_image_processing_params = {'random_ccm': False, 'random_gains': False, 'smoothstep': False,
+                                       'gamma': False,
+                                       'add_noise': False}
 
-                          NOTE: The flow_vectors are only available during training for the purpose of using any
-                                auxiliary losses if needed. The flow_vectors will NOT be provided for the bursts in the
-                                test set
 
-            meta_info: A dictionary containing the parameters used to generate the synthetic burst.
+class SyntheticBurstRGBAligned(SyntheticBurstRGB):
+    """ Same as SyntheticBurstRGB, but the frames of burst_rgb are aligned to the base frame with a homography (see
+    align) and a dict with the aligned burst ('LR') and the ground truth ('HR') is returned.
+    """
+    # ECC settings used by align(). They are built once here instead of once per frame.
+    ecc_warp_mode = cv2.MOTION_HOMOGRAPHY
+    # A termination eps below the float32 precision is never reached, so ECC always runs all iterations anyway
+    ecc_criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 5, 1e-4)
+    ecc_warp_init = np.eye(3, 3, dtype=np.float32)
+    # ECC is run on gray images downscaled by this factor, and the homography is then scaled back to full resolution
+    ecc_downscale = 2
+    ecc_min_ncc = ECC_MIN_NCC
+    ecc_min_cc = ECC_MIN_CC
+    # ORB settings. The LR frames are small (96x96 for the default crop), so the default 31 pixel patch would leave
+    # almost no room for keypoints away from the border
+    orb_features = 500
+    orb_patch_size = 15
+
+    def __init__(self, base_dataset, burst_size=8, crop_sz=384, transform=FastToTensor(), align_method='gt',
+                 uint8_output=False, output_dtype=None):
+        """ align_method selects how the homography between a burst frame and the base frame is obtained in
+        align(): 'gt' (the known transformations used to generate the burst, no estimation), 'lk' (sparse pyramidal
+        Lucas-Kanade + RANSAC), 'orb' (ORB feature matching + RANSAC) or 'ecc' (dense ECC, the original behaviour).
+        If uint8_output is True, the aligned burst ('LR') is returned as uint8 and has to be converted back to float
+        after the host to device copy, see data.utils.data_format_utils.to_device_float. output_dtype is
+        described in _SyntheticBurstBase.__init__, it does not apply to a uint8 'LR'.
         """
-        frame = self.base_dataset[index]
-
-        # Augmentation, e.g. convert to tensor
-        if self.transform is not None:
-            # frame = Image.fromarray(frame)
-            frame = self.transform(frame)
+        assert align_method in ('gt', 'lk', 'orb', 'ecc'), 'Unknown align_method {}'.format(align_method)
+        super().__init__(base_dataset, burst_size=burst_size, crop_sz=crop_sz, transform=transform,
+                         output_dtype=output_dtype)
+        self.align_method = align_method
+        self.uint8_output = uint8_output
 
-        # Extract a random crop from the image
-        crop_sz = self.crop_sz + 2 * self.burst_transformation_params.get('border_crop', 0)
-        frame_crop = random_crop(frame, crop_sz)
+    def _postprocess(self, burst, frame_gt, burst_rgb, flow_vectors, meta_info):
+        burst_rgb = self.align(burst_rgb, meta_info['burst_homographies'])
 
-        # Generate RAW burst
-        burst, frame_gt, burst_rgb, flow_vectors, meta_info = rgb2rawburst(frame_crop,
-                                                                           self.burst_size,
-                                                                           self.downsample_factor,
-                                                                           burst_transformation_params=self.burst_transformation_params,
-                                                                           image_processing_params=self.image_processing_params,
-                                                                           interpolation_type=self.interpolation_type
-                                                                           )
-        
-        burst_rgb = self.align(burst_rgb)
-
-        if self.burst_transformation_params.get('border_crop') is not None:
-            border_crop = self.burst_transformation_params.get('border_crop')
-            frame_gt = frame_gt[:, border_crop:-border_crop, border_crop:-border_crop]
-        
         data = {}
         data['LR'] = burst_rgb
         data['HR'] = frame_gt
 
         return data
-    
-    def align(self, burst_rgb):
-        # tensor to PIL numpy
-        burst_rgb = burst_rgb.numpy()*255
-        burst_rgb = burst_rgb.astype('uint8')
-        burst_rgb = np.transpose(burst_rgb, (0, 2, 3, 1))
-        # HOMOGRAPHY
-        for i in range(1, 14):
-            im1 = burst_rgb[0]
-            im2 = burst_rgb[i]
-            im1_gray = cv2.cvtColor(im1, cv2.COLOR_BGR2GRAY)
-            im2_gray = cv2.cvtColor(im2, cv2.COLOR_BGR2GRAY)
-            sz = im1.shape
-            warp_mode = cv2.MOTION_HOMOGRAPHY
-            if warp_mode == cv2.MOTION_HOMOGRAPHY:
-                warp_matrix = np.eye(3, 3, dtype=np.float32)
+
+    def _ecc_homography(self, im1_gray, im2_gray):
+        return _ecc_warp(im1_gray, im2_gray, self.ecc_warp_init, self.ecc_warp_mode, self.ecc_criteria,
+                         downscale=self.ecc_downscale, min_ncc=self.ecc_min_ncc, min_cc=self.ecc_min_cc)
+
+    def _lk_homography(self, im1_gray, im2_gray, im1_pts):
+        if im1_pts is None:
+            # no corners in the base frame
+            return None
+        # Track the reference corners into im2 and fit a homography mapping im1 coordinates to im2 coordinates
+        im2_pts, status, _ = cv2.calcOpticalFlowPyrLK(im1_gray, im2_gray, im1_pts, None,
+                                                      winSize=(21, 21), maxLevel=3)
+        status = status.ravel() == 1
+        if status.sum() < 4:
+            return None
+        warp_matrix, _ = cv2.findHomography(im1_pts[status], im2_pts[status], cv2.RANSAC, 3.0)
+        return warp_matrix
+
+    def _create_orb(self):
+        return cv2.ORB_create(self.orb_features, edgeThreshold=self.orb_patch_size,
+                              patchSize=self.orb_patch_size)
+
+    def _orb_homography(self, im1_gray, im2_gray, im1_features):
+        kp1, des1 = im1_features
+        if des1 is None:
+            # no keypoints in the base frame
+            return None
+        # Match the descriptors of im2 against the ones of the base frame and fit a homography mapping im1
+        # coordinates to im2 coordinates
+        kp2, des2 = self._create_orb().detectAndCompute(im2_gray, None)
+        if des2 is None:
+            return None
+        matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(des1, des2)
+        if len(matches) < 4:
+            return None
+        pts1 = np.float32([kp1[m.queryIdx].pt for m in matches])
+        pts2 = np.float32([kp2[m.trainIdx].pt for m in matches])
+        warp_matrix, _ = cv2.findHomography(pts1, pts2, cv2.RANSAC, 3.0)
+        return warp_matrix
+
+    def _to_gray(self, burst):
+        """ Converts a [N, H, W, 3] burst to gray with a single cvtColor call on the frames stacked along the rows """
+        n, h, w, c = burst.shape
+        burst_gray = self._scratch_buffer('burst_gray', (n * h, w))
+        cv2.cvtColor(burst.reshape(n * h, w, c), cv2.COLOR_BGR2GRAY, dst=burst_gray)
+        if self.align_method in ('lk', 'orb'):
+            # calcOpticalFlowPyrLK and ORB only accept 8-bit images
+            burst_gray = cv2.convertScaleAbs(burst_gray, alpha=255.0)
+        return burst_gray.reshape(n, h, w)
+
+    def _align_frame(self, im1_gray, im1_features, dsize, im2, im2_gray, fallback_matrix, dst):
+        """ Warps im2 onto the base frame and writes the result to dst. If the homography can not be estimated,
+        fallback_matrix (the ground truth transformation) is used instead. If that is None as well, im2 is copied
+        unchanged. """
+        if self.align_method == 'lk':
+            warp_matrix = self._lk_homography(im1_gray, im2_gray, im1_features)
+        elif self.align_method == 'orb':
+            warp_matrix = self._orb_homography(im1_gray, im2_gray, im1_features)
+        else:
+            warp_matrix = self._ecc_homography(im1_gray, im2_gray)
+        if warp_matrix is None:
+            warp_matrix = fallback_matrix
+        if warp_matrix is None:
+            dst[...] = im2
+            return
+        self._warp_frame(im2, warp_matrix, dsize, dst)
+
+    def _scratch_umat(self, name, shape):
+        """ Same as _scratch_buffer, for a float32 [H, W, C] cv2.UMat """
+        scratch = self.__dict__.get('_scratch')
+        if scratch is None:
+            scratch = self.__dict__.setdefault('_scratch', threading.local())
+        entry = getattr(scratch, 'umat_' + name, None)
+        if entry is None or entry[0] != tuple(shape):
+            entry = (tuple(shape), cv2.UMat(shape[0], shape[1], cv2.CV_32FC(shape[2])))
+            setattr(scratch, 'umat_' + name, entry)
+        return entry[1]
+
+    def _warp_frame(self, im2, warp_matrix, dsize, dst):
+        """ Warps im2 with warp_matrix onto the base frame and writes the result to dst """
+        # Use warpPerspective for Homography
+        flags = cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP
+        if cv2.ocl.useOpenCL():
+            # Dispatch the warp to OpenCV's OpenCL (T-API) kernels, through per-thread device buffers which are
+            # allocated once. Without an OpenCL device, UMat only adds an upload and a download per frame
+            src_umat = self._scratch_umat('src', im2.shape)
+            dst_umat = self._scratch_umat('dst', dst.shape)
+            cv2.copyTo(im2, None, dst=src_umat)
+            cv2.warpPerspective(src_umat, warp_matrix, dsize, dst=dst_umat, flags=flags)
+            dst[...] = dst_umat.get()
+        else:
+            cv2.warpPerspective(im2, warp_matrix, dsize, dst=dst, flags=flags)
+
+    def align(self, burst_rgb, homographies=None):
+        """ Warps every frame of burst_rgb onto the first one. homographies are the ground truth transformations
+        returned by rgb2rawburst in meta_info['burst_homographies']. They are used directly if align_method is 'gt',
+        and as a fallback for frames where the homography can not be estimated otherwise. """
+        if self._static_burst:
+            # Without random motion all frames are already aligned
+            if self.uint8_output:
+                return burst_rgb.mul(255.0).round_().clamp_(0, 255).to(torch.uint8)
+            return burst_rgb.contiguous()
+        # tensor to float32 HWC numpy. cvtColor, findTransformECC and warpPerspective all accept CV_32F, so the
+        # burst is not quantized to uint8 and no rescaling is needed on the way back. The HWC copy and the aligned
+        # frames go into per-thread staging arrays which are allocated once and reused across samples
+        shape = (burst_rgb.shape[0], burst_rgb.shape[2], burst_rgb.shape[3], burst_rgb.shape[1])
+        burst_hwc = self._scratch_buffer('burst_hwc', shape)
+        burst_aligned = self._scratch_buffer('burst_aligned', shape)
+        np.copyto(burst_hwc, burst_rgb.permute(0, 2, 3, 1).numpy())
+        im1 = burst_hwc[0]
+        burst_aligned[0] = im1
+        dsize = (im1.shape[1], im1.shape[0])
+        if self.align_method == 'gt':
+            # The burst was generated with known transformations, so nothing has to be estimated
+            for i in range(1, burst_hwc.shape[0]):
+                self._warp_frame(burst_hwc[i], homographies[i].numpy(), dsize, burst_aligned[i])
+        else:
+            burst_gray = self._to_gray(burst_hwc)
+            im1_gray = burst_gray[0]
+            im1_features = None
+            if self.align_method == 'lk':
+                # Corners are detected once on the reference frame and tracked into every other frame. The burst
+                # motion is a small translation + rotation, so sparse pyramidal LK is much cheaper than per-frame ECC.
+                im1_features = cv2.goodFeaturesToTrack(im1_gray, maxCorners=500, qualityLevel=0.01, minDistance=8)
+            elif self.align_method == 'orb':
+                # Keypoints and descriptors of the reference frame are computed once and matched against every frame
+                im1_features = self._create_orb().detectAndCompute(im1_gray, None)
+            if homographies is not None:
+                fallback_matrices = list(homographies[1:].numpy())
             else:
-                warp_matrix = np.eye(2, 3, dtype=np.float32)
-            number_of_iterations = 10
-            termination_eps = 1e-10
-            criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, number_of_iterations, termination_eps)
-            try:
-                # Run the ECC algorithm. The results are stored in warp_matrix.
-                (cc, warp_matrix) = cv2.findTransformECC(im1_gray, im2_gray, warp_matrix, warp_mode, criteria)
-
-                if warp_mode == cv2.MOTION_HOMOGRAPHY:
-                    # Use warpPerspective for Homography
-                    im2_aligned = cv2.warpPerspective(im2, warp_matrix, (sz[1], sz[0]),
-                                                    flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
-                else:
-                    # Use warpAffine for Translation, Euclidean and Affine
-                    im2_aligned = cv2.warpAffine(im2, warp_matrix, (sz[1], sz[0]),
-                                                flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
-                burst_rgb[i] = im2_aligned
-            except:
-                burst_rgb[i] = im1
-        # PIL numpy to tensor
-        burst_rgb = np.transpose(burst_rgb, (0, 3, 1, 2))
-        burst_rgb = torch.from_numpy(burst_rgb) / 255.0
-        burst_rgb = burst_rgb.clamp(0.0, 1.0)
+                fallback_matrices = [None] * (burst_hwc.shape[0] - 1)
+            # HOMOGRAPHY. Every frame is registered against the base frame independently, so they are aligned in
+            # parallel
+            list(get_align_pool().map(partial(self._align_frame, im1_gray, im1_features, dsize),
+                                      burst_hwc[1:], burst_gray[1:], fallback_matrices, burst_aligned[1:]))
+        if self.uint8_output:
+            # scale, round and saturate to uint8 in one pass; the division by 255 is done on the GPU
+            burst_aligned = cv2.convertScaleAbs(burst_aligned.reshape(-1, *shape[2:]), alpha=255.0).reshape(shape)
+        # numpy to tensor. contiguous() copies the permuted view, so the returned tensor does not alias the
+        # staging array
+        burst_rgb = torch.from_numpy(burst_aligned).permute(0, 3, 1, 2).contiguous()
         return burst_rgb
 
 
-class SyntheticBurstRAWAligned(torch.utils.data.Dataset):
-    """ Synthetic burst dataset for joint denoising, demosaicking, and super-resolution. RAW Burst sequences are
-    synthetically generated on the fly as follows. First, a single image is loaded from the base_dataset. The sampled
-    image is converted to linear sensor space using the inverse camera pipeline employed in [1]. A burst
-    sequence is then generated by adding random translations and rotations to the converted image. The generated burst
-    is then converted is then mosaicked, and corrupted by random noise to obtain the RAW burst.
-
-    [1] Unprocessing Images for Learned Raw Denoising, Brooks, Tim and Mildenhall, Ben and Xue, Tianfan and Chen,
-    Jiawen and Sharlet, Dillon and Barron, Jonathan T, CVPR 2019
+class SyntheticBurstRAWAligned(SyntheticBurst):
+    """ Same as SyntheticBurst, but the RAW burst is aligned to the base frame (see align) and a dict with the aligned
+    burst ('LR'), the ground truth ('HR') and the demosaiced base frame ('base frame') is returned.
     """
-    def __init__(self, base_dataset, burst_size=8, crop_sz=384, transform=tfm.ToTensor()):
-        self.base_dataset = base_dataset
-
-        self.burst_size = burst_size
-        self.crop_sz = crop_sz
-        self.transform = transform
-
-        self.downsample_factor = 4
-        self.burst_transformation_params = {'max_translation': 24.0,
-                                            'max_rotation': 1.0,
-                                            'max_shear': 0.0,
-                                            'max_scale': 0.0,
-                                            'border_crop': 24}
-
-        self.image_processing_params = {'random_ccm': True, 'random_gains': True, 'smoothstep': True,
-                                        'gamma': True,
-                                        'add_noise': True}
-        self.interpolation_type = 'bilinear'
-
-    def __len__(self):
-        return len(self.base_dataset)
-
-    def __getitem__(self, index):
-        """ Generates a synthetic burst
-        args:
-            index: Index of the image in the base_dataset used to generate the burst
-
-        returns:
-            burst: Generated LR RAW burst, a torch tensor of shape
-                   [burst_size, 4, self.crop_sz / (2*self.downsample_factor), self.crop_sz / (2*self.downsample_factor)]
-                   The 4 channels correspond to 'R', 'G', 'G', and 'B' values in the RGGB bayer mosaick.
-                   The extra factor 2 in the denominator (2*self.downsample_factor) corresponds to the mosaicking
-                   operation.
-
-            frame_gt: The HR RGB ground truth in the linear sensor space, a torch tensor of shape
-                      [3, self.crop_sz, self.crop_sz]
-
-            flow_vectors: The ground truth flow vectors between a burst image and the base image (i.e. the first image in the burst).
-                          The flow_vectors can be used to warp the burst images to the base frame, using the 'warp'
-                          function in utils.warp package.
-                          flow_vectors is torch tensor of shape
-                          [burst_size, 2, self.crop_sz / self.downsample_factor, self.crop_sz / self.downsample_factor].
-                          Note that the flow_vectors are in the LR RGB space, before mosaicking. Hence it has twice
-                          the number of rows and columns, compared to the output burst.
-
-                          NOTE: The flow_vectors are only available during training for the purpose of using any
-                                auxiliary losses if needed. The flow_vectors will NOT be provided for the bursts in the
-                                test set
-
-            meta_info: A dictionary containing the parameters used to generate the synthetic burst.
+    # ECC settings used by estimate_warps(), built once here instead of once per burst. ecc_warp_init has to match
+    # ecc_warp_mode (3x3 for MOTION_HOMOGRAPHY, 2x3 otherwise)
+    ecc_warp_mode = cv2.MOTION_HOMOGRAPHY
+    ecc_warp_init = np.eye(3, 3, dtype=np.float32)
+    # The burst motion is small, and most of the accuracy is reached after 3 iterations. The eps is not reached
+    # within that many iterations in practice, so the iteration count is what bounds the cost
+    ecc_criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 3, 1e-4)
+    # align() estimates the warps on frames downscaled by this factor, see find_transform_ecc. The RAW planes are
+    # already small, and downscaling them further makes ECC noticeably less accurate, so this is off by default
+    ecc_downscale = 1
+    # If set, ECC is initialized with a translation estimated at half resolution (see pyramid_ecc) instead of the
+    # identity, and runs fewer iterations at full resolution. ecc_downscale is then not used. The burst motion is only a
+    # few pixels of the RAW planes, so ECC converges from the identity as well and this is off by default
+    ecc_pyramid = False
+    ecc_pyramid_criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 3, 1e-6)
+    ecc_coarse_criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 1e-4)
+    # align_method 'phase': translations with a lower phase correlation response are not used, and the number of ECC
+    # iterations that refine the translation (0 to use the translation as is)
+    phase_min_response = 0.3
+    phase_ecc_iterations = 2
+    ecc_min_ncc = ECC_MIN_NCC
+    ecc_min_cc = ECC_MIN_CC
+    # align_method 'ic': criteria of InverseCompositionalECC, and the border of the base frame that is not used. The
+    # burst motion is at most a few pixels of the RAW planes
+    ic_criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 5, 1e-4)
+    ic_margin = 4
+    # A pixel of the RAW planes covers raw_block_size x raw_block_size pixels of the LR RGB frames
+    raw_block_size = 2
+
+    def __init__(self, base_dataset, burst_size=8, crop_sz=384, transform=FastToTensor(), align_method='gt',
+                 output_dtype=None, warp_on_device=False):
+        """ align_method selects how the warps between a burst frame and the base frame are obtained in align():
+        'gt' (the known transformations used to generate the burst, no estimation), 'ecc' (ECC, the original
+        behaviour), 'phase' (ECC initialized with the translation found by phase correlation, see _estimate_warp) or
+        'ic' (ECC in the inverse compositional formulation, see InverseCompositionalECC).
+        output_dtype is described in _SyntheticBurstBase.__init__.
+        If warp_on_device is True, the frames are not warped by the dataset. The unwarped burst is returned as 'LR',
+        and the [N, 3, 3] warps as 'LR_warps', which the trainer applies after the host to device copy (see
+        data.utils.warp.warp_homography).
         """
-        frame = self.base_dataset[index]
+        assert align_method in ('gt', 'ecc', 'phase', 'ic'), 'Unknown align_method {}'.format(align_method)
+        super().__init__(base_dataset, burst_size=burst_size, crop_sz=crop_sz, transform=transform,
+                         output_dtype=output_dtype)
+        self.align_method = align_method
+        self.warp_on_device = warp_on_device
 
-        # Augmentation, e.g. convert to tensor
-        if self.transform is not None:
-            # frame = Image.fromarray(frame)
-            frame = self.transform(frame)
-
-        # Extract a random crop from the image
-        crop_sz = self.crop_sz + 2 * self.burst_transformation_params.get('border_crop', 0)
-        frame_crop = random_crop(frame, crop_sz)
-
-        # Generate RAW burst
-        burst, frame_gt, burst_rgb, flow_vectors, meta_info = rgb2rawburst(frame_crop,
-                                                                           self.burst_size,
-                                                                           self.downsample_factor,
-                                                                           burst_transformation_params=self.burst_transformation_params,
-                                                                           image_processing_params=self.image_processing_params,
-                                                                           interpolation_type=self.interpolation_type
-                                                                           )
-        
-        burst = self.align(burst)
-
-        if self.burst_transformation_params.get('border_crop') is not None:
-            border_crop = self.burst_transformation_params.get('border_crop')
-            frame_gt = frame_gt[:, border_crop:-border_crop, border_crop:-border_crop]
-        
+    def _postprocess(self, burst, frame_gt, burst_rgb, flow_vectors, meta_info):
         data = {}
-        data['LR'] = burst
+        if self.warp_on_device:
+            data['LR'], data['LR_warps'] = self.align(burst, meta_info['burst_homographies'], return_warps=True)
+        else:
+            data['LR'] = self.align(burst, meta_info['burst_homographies'])
         data['HR'] = frame_gt
-        flattened_image = flatten_raw_image(data['LR'][0])
-        demosaiced_image = colour_demosaicing.demosaicing_CFA_Bayer_Menon2007(flattened_image.numpy())
-        base_frame = torch.clamp(torch.from_numpy(demosaiced_image).type_as(flattened_image),
-                                 min=0.0, max=1.0).permute(2, 0, 1)
-        data['base frame'] = base_frame
+        data['base frame'] = raw4_to_rgb(data['LR'][0])
 
         return data
-    
-    def align(self, burst):
-        # tensor to PIL numpy
-        burst = burst.numpy()*(2**14)
-        # burst = burst.astype('np.float32')
-        burst = np.transpose(burst, (0, 2, 3, 1))
-        # HOMOGRAPHY
-        for i in range(1, 14):
-            for channel_i in range(0, 4):
-                im1_gray = burst[0, :, :, channel_i]
-                im2_gray = burst[i, :, :, channel_i]
-                im1_warp = np.expand_dims(im1_gray, axis=2)
-                im2_warp = np.expand_dims(im2_gray, axis=2)
-                sz = burst[0].shape
-                warp_mode = cv2.MOTION_HOMOGRAPHY
-                if warp_mode == cv2.MOTION_HOMOGRAPHY:
-                    warp_matrix = np.eye(3, 3, dtype=np.float32)
-                else:
-                    warp_matrix = np.eye(2, 3, dtype=np.float32)
-                number_of_iterations = 10
-                termination_eps = 1e-10
-                criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, number_of_iterations, termination_eps)
-                try:
-                    # Run the ECC algorithm. The results are stored in warp_matrix.
-                    (cc, warp_matrix) = cv2.findTransformECC(im1_gray, im2_gray, warp_matrix, warp_mode, criteria)
-
-                    if warp_mode == cv2.MOTION_HOMOGRAPHY:
-                        # Use warpPerspective for Homography
-                        im2_aligned = cv2.warpPerspective(im2_warp, warp_matrix, (sz[1], sz[0]),
-                                                        flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
-                    else:
-                        # Use warpAffine for Translation, Euclidean and Affine
-                        im2_aligned = cv2.warpAffine(im2_warp, warp_matrix, (sz[1], sz[0]),
-                                                    flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
-                    burst[i, :, :, channel_i] = im2_aligned
-                except:
-                    burst[i, :, :, channel_i] = im1_gray
-        # PIL numpy to tensor
-        burst = np.transpose(burst, (0, 3, 1, 2))
-        burst = torch.from_numpy(burst) / (2**14)
-        burst = burst.clamp(0.0, 1.0)
-        return burst
-
-
-class SyntheticBurstQuadAligned(torch.utils.data.Dataset):
-    """ Synthetic burst dataset for joint denoising, demosaicking, and super-resolution. RAW Burst sequences are
-    synthetically generated on the fly as follows. First, a single image is loaded from the base_dataset. The sampled
-    image is converted to linear sensor space using the inverse camera pipeline employed in [1]. A burst
-    sequence is then generated by adding random translations and rotations to the converted image. The generated burst
-    is then converted is then mosaicked, and corrupted by random noise to obtain the RAW burst.
 
-    [1] Unprocessing Images for Learned Raw Denoising, Brooks, Tim and Mildenhall, Ben and Xue, Tianfan and Chen,
-    Jiawen and Sharlet, Dillon and Barron, Jonathan T, CVPR 2019
+    def _gt_warps(self, homographies):
+        """ The ground truth homographies between the LR RGB frames (meta_info['burst_homographies']), in RAW plane
+        coordinates """
+        # Conjugate with the map from RAW plane to LR RGB pixel coordinates (block centers)
+        k = self.raw_block_size
+        plane2rgb = np.array([[k, 0.0, (k - 1) / 2.0],
+                              [0.0, k, (k - 1) / 2.0],
+                              [0.0, 0.0, 1.0]])
+        warps = np.linalg.inv(plane2rgb) @ homographies.numpy().astype(np.float64) @ plane2rgb
+        return warps.astype(np.float32)
+
+    def _estimate_warp(self, im1_gray, im2_gray, warp_matrix_init, warp_mode, criteria, criteria_coarse):
+        """ Estimates the warp between im1_gray and im2_gray, or returns None if that fails """
+        if self.align_method == 'phase':
+            response, warp_matrix = phase_correlate_warp(im1_gray, im2_gray, warp_matrix_init)
+            # Otherwise the shift is unreliable, and ECC is run as for align_method 'ecc'
+            if response >= self.phase_min_response:
+                if self.phase_ecc_iterations == 0:
+                    return warp_matrix
+                # The phase correlation is only accurate to a fraction of a pixel on the small RAW planes, and does
+                # not capture the rotation, so it is refined with a few ECC iterations
+                warp_matrix_init = warp_matrix
+                criteria = (criteria[0], self.phase_ecc_iterations, criteria[2])
+                criteria_coarse = None
+        return _ecc_warp(im1_gray, im2_gray, warp_matrix_init, warp_mode, criteria, downscale=self.ecc_downscale,
+                         min_ncc=self.ecc_min_ncc, criteria_coarse=criteria_coarse, min_cc=self.ecc_min_cc)
+
+    def estimate_warps(self, burst_hwc, homographies=None):
+        """ Returns the [N, 3, 3] warps between the base frame and every frame of the [N, H, W, C] array burst_hwc,
+        in the convention of cv2.warpPerspective with WARP_INVERSE_MAP. homographies are the ground truth
+        transformations returned by rgb2rawburst in meta_info['burst_homographies']. They are used directly if
+        align_method is 'gt', and as a fallback for frames whose warp can not be estimated otherwise. If they are
+        None as well, the warp of such a frame is the identity, i.e. the frame is left unaligned.
+
+        The estimated warps are not cached by index: the crop, the burst motion and the noise are sampled anew for
+        every sample, so a burst is never seen twice. Use align_method 'gt' to skip the estimation instead. """
+        if self.align_method == 'gt':
+            # The burst was generated with known transformations, so nothing has to be estimated
+            return self._gt_warps(homographies)
+        if self.ecc_pyramid:
+            criteria, criteria_coarse = self.ecc_pyramid_criteria, self.ecc_coarse_criteria
+        else:
+            criteria, criteria_coarse = self.ecc_criteria, None
+        # All channels of a frame are moved by the same camera motion, so the warp is estimated once per frame, on
+        # the mean of the channels, which also averages out the noise of the single channels. The mean over the
+        # innermost axis is computed as a float32 matrix-vector product, which is much faster than mean(axis=3)
+        num_channels = burst_hwc.shape[3]
+        burst_gray = burst_hwc @ np.full(num_channels, 1.0 / num_channels, dtype=np.float32)
+        im1_gray = burst_gray[0]
+
+        if self.align_method == 'ic':
+            # The linearization around the base frame is computed once and shared by all the frames
+            ic_ecc = InverseCompositionalECC(im1_gray, margin=self.ic_margin)
+
+            def estimate(i):
+                cc, warp_matrix = ic_ecc.find_transform(burst_gray[i], np.eye(3, dtype=np.float32), self.ic_criteria)
+                return warp_matrix if cc >= self.ecc_min_cc else None
+        else:
+            def estimate(i):
+                return self._estimate_warp(im1_gray, burst_gray[i], self.ecc_warp_init, self.ecc_warp_mode,
+                                           criteria, criteria_coarse)
+
+        # HOMOGRAPHY. Every frame is registered against the base frame independently, so they are estimated in
+        # parallel
+        warps = np.tile(np.eye(3, dtype=np.float32), (burst_hwc.shape[0], 1, 1))
+        gt_warps = None
+        for i, warp_matrix in enumerate(get_align_pool().map(estimate, range(1, burst_hwc.shape[0])), 1):
+            if warp_matrix is not None:
+                # An affine warp_matrix is the first 2 rows of the 3x3 matrix
+                warps[i, :warp_matrix.shape[0]] = warp_matrix
+            elif homographies is not None:
+                if gt_warps is None:
+                    gt_warps = self._gt_warps(homographies)
+                warps[i] = gt_warps[i]
+        return warps
+
+    def align(self, burst, homographies=None, return_warps=False):
+        """ Warps every frame of the [N, C, H, W] RAW burst onto the first one, see estimate_warps. If return_warps
+        is True, the frames are not warped, and the burst is returned together with the [N, 3, 3] tensor of
+        warps. """
+        if self._static_burst:
+            burst = burst.clamp(0.0, 1.0).contiguous()
+            if return_warps:
+                return burst, torch.eye(3).repeat(burst.shape[0], 1, 1)
+            return burst
+        # tensor to float32 HWC numpy. findTransformECC and warpPerspective work on CV_32F directly, and ECC is
+        # invariant to the intensity scale, so the burst is not rescaled. They have no CV_16F kernels, so a half
+        # precision burst would have to be converted back and forth around every call; use output_dtype to return
+        # the burst in float16 instead. The HWC copy goes into a per-thread staging array which is allocated once
+        # and reused across samples, and whose frames are contiguous, so OpenCV does not copy them again. Bilinear
+        # warping does not leave [0, 1], so the burst is only clamped here, in the same pass as the HWC copy
+        shape = (burst.shape[0], burst.shape[2], burst.shape[3], burst.shape[1])
+        burst_hwc = self._scratch_buffer('raw_hwc', shape)
+        np.clip(burst.permute(0, 2, 3, 1).numpy(), 0.0, 1.0, out=burst_hwc)
+        warps = self.estimate_warps(burst_hwc, homographies)
+        if return_warps:
+            # numpy to tensor. contiguous() copies the permuted view, so the returned tensor does not alias the
+            # staging array
+            return torch.from_numpy(burst_hwc).permute(0, 3, 1, 2).contiguous(), torch.from_numpy(warps)
+
+        # The aligned frames are written into a fresh array which is returned without a further copy, as a
+        # [N, C, H, W] view with channels_last strides. It cannot be a buffer shared across samples, since the
+        # DataLoader collates several samples of a worker at once, and collate makes the batch contiguous anyway
+        burst_aligned = np.empty(shape, dtype=np.float32)
+        burst_aligned[0] = burst_hwc[0]
+        dsize = (shape[2], shape[1])
+
+        def warp_frame(i):
+            # Use warpPerspective for Homography
+            cv2.warpPerspective(burst_hwc[i], warps[i], dsize, dst=burst_aligned[i],
+                                flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+
+        list(get_align_pool().map(warp_frame, range(1, shape[0])))
+        return torch.from_numpy(burst_aligned).permute(0, 3, 1, 2)
+
+
+class SyntheticBurstQuadAligned(SyntheticBurstRAWAligned):
+    """ Quad Bayer version of SyntheticBurstRAWAligned. The burst is generated with rgb2rawburst_quad (16 channels per
+    frame) and downsampled by 2 instead of 4, and a dict with the aligned burst ('LR') and the ground truth ('HR') is
+    returned.
     """
-    def __init__(self, base_dataset, burst_size=14, crop_sz=608, transform=tfm.ToTensor()):
-        self.base_dataset = base_dataset
-
-        self.burst_size = burst_size
-        self.crop_sz = crop_sz
-        self.transform = transform
+    raw_block_size = 4
 
+    def __init__(self, base_dataset, burst_size=14, crop_sz=608, transform=FastToTensor(), align_method='gt',
+                 output_dtype=None, warp_on_device=False):
+        super().__init__(base_dataset, burst_size=burst_size, crop_sz=crop_sz, transform=transform,
+                         align_method=align_method, output_dtype=output_dtype, warp_on_device=warp_on_device)
         self.downsample_factor = 2
-        self.burst_transformation_params = {'max_translation': 24.0,
-                                            'max_rotation': 1.0,
-                                            'max_shear': 0.0,
-                                            'max_scale': 0.0,
-                                            # 'border_crop': 16}
-                                            'border_crop': 24}
-
-        self.image_processing_params = {'random_ccm': True, 'random_gains': True, 'smoothstep': True,
-                                        'gamma': True,
-                                        'add_noise': True}
-        self.interpolation_type = 'bilinear'
-
-    def __len__(self):
-        return len(self.base_dataset)
-
-    def __getitem__(self, index):
-        """ Generates a synthetic burst
-        args:
-            index: Index of the image in the base_dataset used to generate the burst
-
-        returns:
-            burst: Generated LR RAW burst, a torch tensor of shape
-                   [burst_size, 4, self.crop_sz / (2*self.downsample_factor), self.crop_sz / (2*self.downsample_factor)]
-                   The 4 channels correspond to 'R', 'G', 'G', and 'B' values in the RGGB bayer mosaick.
-                   The extra factor 2 in the denominator (2*self.downsample_factor) corresponds to the mosaicking
-                   operation.
-
-            frame_gt: The HR RGB ground truth in the linear sensor space, a torch tensor of shape
-                      [3, self.crop_sz, self.crop_sz]
 
-            flow_vectors: The ground truth flow vectors between a burst image and the base image (i.e. the first image in the burst).
-                          The flow_vectors can be used to warp the burst images to the base frame, using the 'warp'
-                          function in utils.warp package.
-                          flow_vectors is torch tensor of shape
-                          [burst_size, 2, self.crop_sz / self.downsample_factor, self.crop_sz / self.downsample_factor].
-                          Note that the flow_vectors are in the LR RGB space, before mosaicking. Hence it has twice
-                          the number of rows and columns, compared to the output burst.
-
-                          NOTE: The flow_vectors are only available during training for the purpose of using any
-                                auxiliary losses if needed. The flow_vectors will NOT be provided for the bursts in the
-                                test set
-
-            meta_info: A dictionary containing the parameters used to generate the synthetic burst.
-        """
-        frame = self.base_dataset[index]
-
-        # Augmentation, e.g. convert to tensor
-        if self.transform is not None:
-            # frame = Image.fromarray(frame)
-            frame = self.transform(frame)
-
-        # Extract a random crop from the image
-        crop_sz = self.crop_sz + 2 * self.burst_transformation_params.get('border_crop', 0)
-        frame_crop = random_crop(frame, crop_sz)
-
-        # Generate RAW burst
-        burst, frame_gt, burst_rgb, flow_vectors, meta_info = rgb2rawburst_quad(frame_crop,
-                                                                           self.burst_size,
-                                                                           self.downsample_factor,
-                                                                           burst_transformation_params=self.burst_transformation_params,
-                                                                           image_processing_params=self.image_processing_params,
-                                                                           interpolation_type=self.interpolation_type,
-                                                                           quad=True############"change!!!"
-                                                                           )
-        # print("burst.shape",burst.shape)#[14,76,76,16]
-        # exit()
-        burst = self.align(burst)
-
-        if self.burst_transformation_params.get('border_crop') is not None:
-            border_crop = self.burst_transformation_params.get('border_crop')
-            frame_gt = frame_gt[:, border_crop:-border_crop, border_crop:-border_crop]
-        
+    def _generate_burst(self, frame_crop):
+        return rgb2rawburst_quad(frame_crop,
+                                 self.burst_size,
+                                 self.downsample_factor,
+                                 burst_transformation_params=self.burst_transformation_params,
+                                 image_processing_params=self.image_processing_params,
+                                 interpolation_type=self.interpolation_type,
+                                 quad=True,
+                                 precomputed_aug=self._sample_camera_params(),
+                                 return_border_cropped=True
+                                 )
+
+    def _postprocess(self, burst, frame_gt, burst_rgb, flow_vectors, meta_info):
         data = {}
-        data['LR'] = burst
-        data['HR'] = frame_gt##绿绿的图
-        # border = self.burst_transformation_params.get('border_crop', 0)
-        # data['HR'] = frame_crop[:, border:-border, border:-border]
-        # flattened_image = flatten_raw_image(data['LR'][0])
-        # demosaiced_image = colour_demosaicing.demosaicing_CFA_Bayer_Menon2007(flattened_image.numpy())
-        # base_frame = torch.clamp(torch.from_numpy(demosaiced_image).type_as(flattened_image),
-        #                          min=0.0, max=1.0).permute(2, 0, 1)
-        # data['base frame'] = base_frame
+        if self.warp_on_device:
+            data['LR'], data['LR_warps'] = self.align(burst, meta_info['burst_homographies'], return_warps=True)
+        else:
+            data['LR'] = self.align(burst, meta_info['burst_homographies'])
+        data['HR'] = frame_gt
 
         return data
-    
-    def align(self, burst):
-        # tensor to PIL numpy
-        burst=(burst.clamp(0.0, 1.0)* 2**14).numpy().astype(np.uint16)
-        
-        # burst = burst.numpy()*(2**14)
-        burst = burst.astype(np.float32)
-        # print(burst.shape)
-        # burst = np.transpose(burst, (0, 2, 3, 1))
-        # HOMOGRAPHY
-        for i in range(1, 14):
-            for channel_i in range(0, 16):
-                im1_gray = burst[0, :, :, channel_i]
-                im2_gray = burst[i, :, :, channel_i]
-                im1_warp = np.expand_dims(im1_gray, axis=2)
-                im2_warp = np.expand_dims(im2_gray, axis=2)
-                sz = burst[0].shape
-                warp_mode = cv2.MOTION_HOMOGRAPHY
-                if warp_mode == cv2.MOTION_HOMOGRAPHY:
-                    warp_matrix = np.eye(3, 3, dtype=np.float32)
-                else:
-                    warp_matrix = np.eye(2, 3, dtype=np.float32)
-                number_of_iterations = 10
-                termination_eps = 1e-10
-                criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, number_of_iterations, termination_eps)
-                try:
-                    # Run the ECC algorithm. The results are stored in warp_matrix.
-                    (cc, warp_matrix) = cv2.findTransformECC(im1_gray, im2_gray, warp_matrix, warp_mode, criteria)
-
-                    if warp_mode == cv2.MOTION_HOMOGRAPHY:
-                        # Use warpPerspective for Homography
-                        im2_aligned = cv2.warpPerspective(im2_warp, warp_matrix, (sz[1], sz[0]),
-                                                        flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
-                    else:
-                        # Use warpAffine for Translation, Euclidean and Affine
-                        im2_aligned = cv2.warpAffine(im2_warp, warp_matrix, (sz[1], sz[0]),
-                                                    flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
-                    burst[i, :, :, channel_i] = im2_aligned
-                except:
-                    burst[i, :, :, channel_i] = im1_gray
-        # PIL numpy to tensor
-        burst = np.transpose(burst, (0, 3, 1, 2))
-        burst = torch.from_numpy(burst).float() / (2**14)
-        burst = burst.clamp(0.0, 1.0)
-        return burst
\ No newline at end of file
+
+    def align(self, burst, homographies=None, return_warps=False):
+        # burst is [burst_size, H, W, 16]. The permuted view is copied back to HWC by SyntheticBurstRAWAligned.align
+        return super().align(burst.permute(0, 3, 1, 2), homographies, return_warps=return_warps)
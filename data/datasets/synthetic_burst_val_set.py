@@ -3,9 +3,9 @@ import torch
 import cv2
 import numpy as np
 import pickle as pkl
-import torchvision.transforms as transforms
 from PIL import Image
 import random
+from data.utils.data_format_utils import FastToTensor
 
 
 class SyntheticBurstVal(torch.utils.data.Dataset):
@@ -86,7 +86,7 @@ class SyntheticBurstValDF2K(torch.utils.data.Dataset):
         # assert crop_sz <= 80, 'crop_sz must be less than or equal to 80'
         super().__init__()
 
-        self.transform = transforms.Compose([transforms.ToTensor()])
+        self.transform = FastToTensor()
 
         self.burst_size = burst_size
         self.split = split
@@ -8,7 +8,6 @@ import cv2
 import numpy as np
 import torch
 import torch.utils.data as data
-import torchvision.transforms as transforms
 import colour_demosaicing
 from libtiff import TIFF
 from libtiff import TIFFfile
@@ -19,6 +18,7 @@ from data.base import BaseDataset, get_dataloader, stratified_random_split
 from data.datasets.synthetic_burst_train_set import SyntheticBurstRGBAligned, SyntheticBurstQuadAligned
 from data.datasets.synthetic_burst_val_set import SyntheticBurstValDF2K
 from data.datasets.zurich_raw2rgb_dataset import DIV2KRGB, DIV2KRGB_quad
+from data.utils.data_format_utils import FastToTensor
 
 
 class Augment_RGB_torch:
@@ -113,7 +113,7 @@ class RealBSR(torch.utils.data.Dataset):
         assert split in ['train', 'val']
         super().__init__()
 
-        self.transform = transforms.Compose([transforms.ToTensor()])
+        self.transform = FastToTensor()
 
         self.burst_size = burst_size
         self.crop_sz = crop_sz
@@ -242,7 +242,7 @@ class RealBSRTest(torch.utils.data.Dataset):
         assert split in ['train', 'val']
         super().__init__()
 
-        self.transform = transforms.Compose([transforms.ToTensor()])
+        self.transform = FastToTensor()
 
         self.burst_size = burst_size
         self.crop_sz = crop_sz
@@ -521,7 +521,8 @@ class DF2KDataset(BaseDataset):
         data_dir = os.path.join(self.data_dir, self.dir)
         if split == 'train':
             dataset = DIV2KRGB(data_dir, split)
-            dataset = SyntheticBurstRGBAligned(dataset, burst_size=self.burst_size, crop_sz=self.size)
+            dataset = SyntheticBurstRGBAligned(dataset, burst_size=self.burst_size, crop_sz=self.size,
+                                               uint8_output=True)
         elif split == 'val':
             dataset = SyntheticBurstValDF2K(data_dir, burst_size=self.burst_size, split=split)
         else:
@@ -529,6 +530,9 @@ class DF2KDataset(BaseDataset):
 
         kwargs = dict(batch_size=batch_size, num_workers=num_workers,
                       num_replicas=world_size, rank=rank)
+        if is_train and num_workers > 0:
+            # bursts are synthesized on the fly, keep the workers (and their buffers) alive across epochs
+            kwargs.update(persistent_workers=True, prefetch_factor=4, worker_init_fn=dataset.worker_init_fn)
         loader = get_dataloader(dataset, shuffle=is_train, drop_last=is_train, **kwargs)
         return loader
 
@@ -548,7 +552,8 @@ class DIV2KDataset(BaseDataset):
         data_dir = os.path.join(self.data_dir, self.dir)
         if split == 'train':
             dataset = DIV2KRGB(data_dir, split)
-            dataset = SyntheticBurstRGBAligned(dataset, burst_size=self.burst_size, crop_sz=self.size)
+            dataset = SyntheticBurstRGBAligned(dataset, burst_size=self.burst_size, crop_sz=self.size,
+                                               uint8_output=True)
         elif split == 'val':
             dataset = SyntheticBurstValDF2K(data_dir, burst_size=self.burst_size, split=split)
         else:
@@ -556,6 +561,9 @@ class DIV2KDataset(BaseDataset):
 
         kwargs = dict(batch_size=batch_size, num_workers=num_workers,
                       num_replicas=world_size, rank=rank)
+        if is_train and num_workers > 0:
+            # bursts are synthesized on the fly, keep the workers (and their buffers) alive across epochs
+            kwargs.update(persistent_workers=True, prefetch_factor=4, worker_init_fn=dataset.worker_init_fn)
         loader = get_dataloader(dataset, shuffle=is_train, drop_last=is_train, **kwargs)
         return loader
 
@@ -973,5 +981,8 @@ class QuadDataset(BaseDataset):
 
         kwargs = dict(batch_size=batch_size, num_workers=num_workers,
                       num_replicas=world_size, rank=rank)
+        if is_train and num_workers > 0:
+            # bursts are synthesized on the fly, keep the workers (and their buffers) alive across epochs
+            kwargs.update(persistent_workers=True, prefetch_factor=4, worker_init_fn=dataset.worker_init_fn)
         loader = get_dataloader(dataset, shuffle=is_train, drop_last=is_train, **kwargs)
         return loader
\ No newline at end of file
@@ -7,6 +7,59 @@ def numpy_to_torch(a: np.ndarray):
     return torch.from_numpy(a).float().permute(2, 0, 1)
 
 
+class FastToTensor:
+    """ Drop-in replacement for torchvision.transforms.ToTensor for HWC images. The image is wrapped with
+    torch.from_numpy without copying, and converted to a float32 CHW tensor in one pass (plus an in-place division for
+    uint8 images), instead of ToTensor's separate transpose, copy and divide passes. The result is a permuted view, i.e.
+    it is not contiguous in CHW order.
+    """
+    def __call__(self, pic):
+        if not isinstance(pic, np.ndarray):
+            # e.g. a PIL image. np.array (not np.asarray) so that torch gets a writable array
+            pic = np.array(pic)
+        if pic.ndim == 2:
+            pic = pic[:, :, None]
+
+        img = torch.from_numpy(pic).permute(2, 0, 1)
+        if img.dtype == torch.uint8:
+            return img.to(torch.float32).div_(255.0)
+        return img.to(torch.float32)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+def to_channels_last(a: torch.Tensor):
+    """ Returns a with its channel dimension (dim -3) stored last. 4D [B, C, H, W] tensors use
+    torch.channels_last. 5D burst batches [B, N, C, H, W] are stored as [B, N, H, W, C], so that the
+    .view(-1, C, H, W) / .flatten(0, 1) done by the models gives a channels_last 4D tensor without a copy. Other
+    tensors are returned unchanged.
+    """
+    if a.dim() == 4:
+        return a.contiguous(memory_format=torch.channels_last)
+    if a.dim() == 5:
+        return a.permute(0, 1, 3, 4, 2).contiguous().permute(0, 1, 4, 2, 3)
+    return a
+
+
+def to_device_float(a: torch.Tensor, device, channels_last=False):
+    """ Moves a to device and converts uint8 images to float32 in [0, 1] there. The copy is non-blocking, so it
+    overlaps with compute when a comes from a DataLoader with pin_memory=True, and a uint8 batch is a quarter of the
+    size of the float32 one. Half precision batches are cast back to float32 on the device as well. With
+    channels_last, image batches are converted to NHWC on the device, see to_channels_last. Otherwise the batch is
+    made contiguous, since datasets may return NHWC-strided samples, which torch.stack keeps without DataLoader
+    workers.
+    """
+    a = a.to(device, non_blocking=True)
+    if a.dtype == torch.uint8:
+        a = a.float().div_(255.0)
+    elif a.dtype in (torch.float16, torch.bfloat16):
+        a = a.float()
+    if channels_last:
+        return to_channels_last(a)
+    return a.contiguous()
+
+
 def torch_to_numpy(a: torch.Tensor):
     return a.permute(1, 2, 0).cpu().numpy()
 
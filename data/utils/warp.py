@@ -33,3 +33,33 @@ def warp(feat, flow, mode='bilinear', padding_mode='zeros'):
     output = F.grid_sample(feat, grid_norm, mode=mode, align_corners=False, padding_mode=padding_mode)
 
     return output
+
+
+def warp_homography(feat, homographies, mode='bilinear', padding_mode='zeros'):
+    """
+    warp a batch of images/tensors with one homography each, in a single grid_sample call
+
+    the homographies map output pixel coordinates to input pixel coordinates, i.e. output(x) = feat(H x), the
+    convention of cv2.warpPerspective with WARP_INVERSE_MAP (e.g. meta_info['burst_homographies'] of rgb2rawburst)
+    feat: [B, C, H, W]
+    homographies: [B, 3, 3]
+
+    """
+    B, C, H, W = feat.size()
+
+    # pixel centers in homogeneous coordinates, [H*W, 3]
+    rowv, colv = torch.meshgrid([torch.arange(H, dtype=feat.dtype, device=feat.device),
+                                 torch.arange(W, dtype=feat.dtype, device=feat.device)], indexing='ij')
+    grid = torch.stack((colv, rowv, torch.ones_like(colv)), dim=-1).view(1, H * W, 3)
+    grid = torch.matmul(grid, homographies.to(feat).transpose(1, 2))
+    grid = grid[..., :2] / grid[..., 2:]
+
+    # scale grid to [-1,1]
+    grid_norm_c = (2.0 * grid[..., 0] + 1.0) / W - 1.0
+    grid_norm_r = (2.0 * grid[..., 1] + 1.0) / H - 1.0
+
+    grid_norm = torch.stack((grid_norm_c, grid_norm_r), dim=-1).view(B, H, W, 2)
+
+    output = F.grid_sample(feat, grid_norm, mode=mode, align_corners=False, padding_mode=padding_mode)
+
+    return output
@@ -38,6 +38,7 @@ def add_parser_argument(parser):
     parser.add_argument('--load_run_number', type=str)
     parser.add_argument('--load_run_ckpt_name', type=str, default='ckpt-last')
     parser.add_argument('--sync_bn', action='store_true')
+    parser.add_argument('--channels_last', action='store_true')
     ## ===================== Training =========================
     parser.add_argument('--auto_resume', action='store_true')
     parser.add_argument('--resume_ckpt', type=str)
@@ -162,6 +163,8 @@ def main():
         arch=opt.arch, dim=opt.dim, burst_size=opt.burst_size,
         in_channel=opt.in_channel, scale=opt.scale,
     ).to(device)
+    if opt.channels_last:
+        model = model.to(memory_format=torch.channels_last)
     model = torch.compile(model)
     # model = torch.compile(model, mode='reduce-overhead')
     if world_size > 1:
@@ -315,7 +318,8 @@ def main():
         device=device,
         resume_ckpt=resume_ckpt,
         aligned=opt.aligned,
-        alignment_net=opt.alignment_net if opt.aligned else None
+        alignment_net=opt.alignment_net if opt.aligned else None,
+        channels_last=opt.channels_last
     )
 
     trainer.train()
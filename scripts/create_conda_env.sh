@@ -3,6 +3,11 @@ conda activate sr_torch2.0
 conda install pytorch torchvision torchaudio pytorch-cuda=11.8 -c pytorch -c nvidia
 conda install matplotlib scikit-image scikit-learn -y
 pip install -r requirements_pip.txt
+# Optional (x86): Pillow-SIMD is a drop-in replacement for Pillow with SIMD image decoding and resizing, it speeds up
+# the PIL based data loaders (RealBSR, SyntheticBurstValDF2K)
+# pip uninstall -y pillow && CC="cc -mavx2" pip install -U --force-reinstall pillow-simd
+# Optional: numba compiles the RAW unpacking used by the synthetic burst datasets
+# pip install numba
 
 # conda install pytorch==1.7.1 torchvision==0.8.2 torchaudio==0.7.2 cudatoolkit=10.1 -c pytorch -y
 
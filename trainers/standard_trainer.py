@@ -15,6 +15,8 @@ from utils.post_processing_vis import generate_processed_image_channel3
 import pickle
 import cv2
 from data.utils.postprocessing_functions import SimplePostProcess
+from data.utils.data_format_utils import to_device_float, to_channels_last
+from data.utils.warp import warp_homography
 
 class StandardTrainer(BaseTrainer):
 
@@ -33,7 +35,8 @@ class StandardTrainer(BaseTrainer):
         resume_ckpt: dict = None,
         keep_eval_mode: bool = False,
         aligned: bool = False,
-        alignment_net: nn.Module = None
+        alignment_net: nn.Module = None,
+        channels_last: bool = False
     ):
         self.opt = manager.get_opt()
         super().__init__(
@@ -52,6 +55,7 @@ class StandardTrainer(BaseTrainer):
         self.keep_eval_mode = keep_eval_mode
         self.aligned = aligned
         self.alignment_net = alignment_net
+        self.channels_last = channels_last
         if self.aligned:
             self.aligned_psnr = AlignedPSNR(alignment_net=alignment_net, boundary_ignore=40)
         self.sr_residuals = None
@@ -117,9 +121,19 @@ class StandardTrainer(BaseTrainer):
         batch = self._next_data_batch(loop_id)
         # batch = [batch['LR'], batch['HR']]
         # return [t.to(self.device) for t in batch]
+        warps = batch.pop('LR_warps', None)
         for name in batch:
             if isinstance(batch[name], torch.Tensor):
-                batch[name] = batch[name].to(self.device)
+                batch[name] = to_device_float(batch[name], self.device,
+                                              channels_last=self.channels_last and warps is None)
+        if warps is not None:
+            # The burst was not warped by the dataset (warp_on_device), all frames of the batch are warped here in a
+            # single grid_sample call
+            lr = batch['LR']
+            warps = warps.to(self.device, non_blocking=True)
+            batch['LR'] = warp_homography(lr.flatten(0, 1), warps.flatten(0, 1)).view_as(lr)
+            if self.channels_last:
+                batch = {k: to_channels_last(v) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
         return batch
 
     def get_active_optimizers(self, loop_id, phase_id):